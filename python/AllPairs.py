@@ -0,0 +1,217 @@
+# AllPairs.py
+# Distances between every pair of images, as a batch job.
+#
+# Run it from the top of the repo:
+# python ./python/AllPairs.py --output pairs -k 10
+# python ./python/AllPairs.py --output pairs --matrix --method intensity_method
+#
+# For every method (or the one given with --method) it writes, into the
+# output folder, either the top k neighbors of every image
+# (<method>.neighbors.npy, image ids, and <method>.neighbor_distances.npy,
+# closest first, the image itself left out) or with --matrix the whole
+# N x N distance matrix (<method>.distances.npy, float32), plus files.txt
+# with the file name of every image id. The .npy files open with
+# np.load(path, mmap_mode="r").
+#
+# The rows are split into stripes, one task each on a pool of worker
+# processes. A worker walks the corpus a tile of TILE_COLUMNS images at a
+# time, so the tile stays in cache for every row of the stripe, and gets
+# the distances to it with DistanceEngine.weighted_distances, QUERY_ROWS
+# rows of the stripe per broadcast. With --matrix the distances to the
+# tile go straight into the output file, otherwise they are merged into a
+# running top k per row. Only the distances to one tile and the top k are
+# in memory, however big the corpus is; the stripe height follows from
+# --memory, the cap for all workers together.
+# The distances are computed exactly like DistanceEngine.query does, with
+# the same weights (pixInfo.weights), so the neighbors are the ones a
+# query gives.
+
+import argparse, os, time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+import DistanceEngine
+from DistanceEngine import METHODS
+from Metrics import metrics
+
+# images of the corpus compared with a stripe at a time, a multiple of 4
+# so every distance is the one a query gets (see weighted_distances)
+TILE_COLUMNS = 256
+
+# rows of the stripe per broadcast, QUERY_ROWS x TILE_COLUMNS x features
+# float64 differences have to fit in cache
+QUERY_ROWS = 8
+
+# largest stripe; a taller one reads the matrix less often, but past this
+# that is nothing next to computing the distances
+MAX_STRIPE_ROWS = 1024
+
+
+# File names of the results of a method in the output folder.
+def output_files(output_dir, method):
+    return {
+        "matrix": os.path.join(output_dir, method + ".matrix.npy"),
+        "distances": os.path.join(output_dir, method + ".distances.npy"),
+        "neighbors": os.path.join(output_dir, method + ".neighbors.npy"),
+        "neighbor_distances": os.path.join(output_dir, method + ".neighbor_distances.npy"),
+    }
+
+
+# Rows of a stripe that fit in memory_bytes: the distances of a row to one
+# tile, and its running top k while a tile is merged into it. The
+# broadcast buffer of every worker comes off first. Every worker gets at
+# least one stripe, and none is over MAX_STRIPE_ROWS.
+def stripe_rows(count, features, memory_bytes, workers, k=None):
+    per_worker = memory_bytes // max(workers, 1) - QUERY_ROWS * TILE_COLUMNS * features * 8
+    per_row = TILE_COLUMNS * 8 + (4 * (k + TILE_COLUMNS) * 8 if k else 0)
+    rows = min(per_worker // per_row, -(-count // max(workers, 1)), MAX_STRIPE_ROWS)
+    return int(max(1, rows))
+
+
+# Merges the distances of a tile into the running top k of every row:
+# best_indices and best_distances are (rows, k), indices are the image
+# ids of the tile columns, all above the ids already in the top k. Ties
+# are broken by image id, like top_k: a stable sort keeps the top k
+# (sorted, ties by id) ahead of the tile, and the tile in id order.
+def merge_top_k(best_indices, best_distances, indices, distances):
+    k = best_indices.shape[1]
+    indices = np.concatenate((best_indices, np.broadcast_to(indices, distances.shape)), axis=1)
+    distances = np.concatenate((best_distances, distances), axis=1)
+    order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(indices, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+
+# Worker process: one stripe of the job, written into the output files.
+# k=None writes the rows of the distance matrix, otherwise the top k
+# neighbors of every row.
+def run_stripe(files, start, stop, weights, k):
+    matrix = np.load(files["matrix"], mmap_mode="r")
+    count = len(matrix)
+    queries = np.asarray(matrix[start:stop], dtype=np.float64)
+    if k is None:
+        out = np.load(files["distances"], mmap_mode="r+")
+    else:
+        best_indices = np.full((stop - start, k), count, dtype=np.int64)
+        best_distances = np.full((stop - start, k), np.inf)
+    rows = np.arange(start, stop)
+    for tile_start in range(0, count, TILE_COLUMNS):
+        tile = matrix[tile_start:tile_start + TILE_COLUMNS]
+        distances = np.empty((stop - start, len(tile)))
+        for row in range(0, stop - start, QUERY_ROWS):
+            distances[row:row + QUERY_ROWS] = DistanceEngine.weighted_distances(
+                tile, queries[row:row + QUERY_ROWS], weights, block_rows=TILE_COLUMNS)
+        if k is None:
+            out[start:stop, tile_start:tile_start + len(tile)] = distances
+            continue
+        # an image is not its own neighbor
+        own = (rows >= tile_start) & (rows < tile_start + len(tile))
+        distances[own.nonzero()[0], rows[own] - tile_start] = np.inf
+        # only the rows where the tile beats the k-th best (a tie loses,
+        # the tile ids are higher) change
+        changed = (distances < best_distances[:, -1:]).any(axis=1).nonzero()[0]
+        if len(changed):
+            best_indices[changed], best_distances[changed] = merge_top_k(
+                best_indices[changed], best_distances[changed],
+                np.arange(tile_start, tile_start + len(tile)), distances[changed])
+    if k is None:
+        out.flush()
+        return stop - start
+
+    neighbors = np.load(files["neighbors"], mmap_mode="r+")
+    neighbor_distances = np.load(files["neighbor_distances"], mmap_mode="r+")
+    neighbors[start:stop] = best_indices
+    neighbor_distances[start:stop] = best_distances
+    neighbors.flush()
+    neighbor_distances.flush()
+    return stop - start
+
+
+class AllPairs:
+    # Constructor. distanceEngine gives the matrices, weights default to the
+    # ones of its pixInfo. memory_mb caps the memory of the stripes of all
+    # workers together, processes is the number of worker processes (all
+    # the cores by default, 1 runs the job in this process).
+    def __init__(self, distanceEngine, output_dir, weights=None, memory_mb=512, processes=None):
+        self.distanceEngine = distanceEngine
+        self.output_dir = output_dir
+        self.weights = weights
+        self.memory_bytes = memory_mb * 1024 * 1024
+        self.processes = processes or os.cpu_count() or 1
+
+    # Computes the job for the method. k=None writes the distance matrix,
+    # otherwise the top k neighbors. Returns the output files.
+    def run(self, method, k=None, progress=None):
+        state = self.distanceEngine.current()
+        matrix = state.get_matrix(method)
+        count, features = matrix.shape
+        weights = np.asarray(self.weights if self.weights is not None else self.distanceEngine.pixInfo.weights,
+                             dtype=np.float64)
+        if k is not None:
+            k = min(k, count - 1)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(os.path.join(self.output_dir, "files.txt"), "w") as f:
+            f.writelines(name + "\n" for name in state.fileList)
+        files = output_files(self.output_dir, method)
+        # the workers map the matrix instead of getting a copy each
+        np.save(files["matrix"], matrix)
+        if k is None:
+            np.lib.format.open_memmap(files["distances"], mode="w+", dtype=np.float32,
+                                      shape=(count, count)).flush()
+        else:
+            np.lib.format.open_memmap(files["neighbors"], mode="w+", dtype=np.int64,
+                                      shape=(count, k)).flush()
+            np.lib.format.open_memmap(files["neighbor_distances"], mode="w+", dtype=np.float64,
+                                      shape=(count, k)).flush()
+
+        rows = stripe_rows(count, features, self.memory_bytes, self.processes, k)
+        stripes = [(start, min(start + rows, count)) for start in range(0, count, rows)]
+        done = 0
+        try:
+            with metrics.timer("allpairs"):
+                if self.processes == 1:
+                    for start, stop in stripes:
+                        done += run_stripe(files, start, stop, weights, k)
+                        if progress is not None:
+                            progress(done, count)
+                else:
+                    with ProcessPoolExecutor(max_workers=self.processes) as pool:
+                        pending = {pool.submit(run_stripe, files, start, stop, weights, k)
+                                   for start, stop in stripes}
+                        while pending:
+                            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            for future in finished:
+                                done += future.result()
+                            if progress is not None:
+                                progress(done, count)
+            metrics.count("distances_computed", count * count)
+        finally:
+            os.remove(files["matrix"])
+        del files["matrix"]
+        if k is None:
+            del files["neighbors"], files["neighbor_distances"]
+        else:
+            del files["distances"]
+        return files
+
+
+# Executable section.
+if __name__ == '__main__':
+    from PixInfo import PixInfo
+
+    parser = argparse.ArgumentParser(description="Distances between every pair of images, written to disk.")
+    parser.add_argument("--output", default="pairs", help="folder to write the results to")
+    parser.add_argument("--method", choices=METHODS, help="only this method (default: all three)")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-k", type=int, default=10, help="neighbors to keep per image")
+    group.add_argument("--matrix", action="store_true", help="write the whole distance matrix instead")
+    parser.add_argument("--memory", type=int, default=512, help="memory cap of the workers, in MB")
+    parser.add_argument("--processes", type=int, help="worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    job = AllPairs(DistanceEngine.DistanceEngine(PixInfo()), args.output, memory_mb=args.memory, processes=args.processes)
+    for method in [args.method] if args.method else METHODS:
+        started = time.perf_counter()
+        files = job.run(method, None if args.matrix else args.k,
+                        progress=lambda done, count: print("\r%s: %d / %d" % (method, done, count), end=""))
+        print("\r%s: %d images in %.1f s -> %s" % (method, len(job.distanceEngine.current()),
+                                                   time.perf_counter() - started, ", ".join(files.values())))
@@ -0,0 +1,153 @@
+# AnnIndex.py
+# Approximate nearest neighbor index for the "Color code & Intensity"
+# (inten_color_method) features.
+#
+# The feature vectors are clustered with k-means into nlist partitions
+# (an inverted file, IVF). A query only scans the nprobe partitions whose
+# centroids are closest to it, so nprobe trades recall for speed:
+# nprobe = nlist scans everything and gives the exact ranking.
+# The relevance feedback weights are applied at query time, both to pick
+# the partitions and to rank their vectors.
+#
+# The partitions hold the vectors quantized to one byte per feature
+# (evenly between the min and the max of the feature), a quarter of the
+# size of the float32 matrix, which the index only references. The scan
+# ranks the probed vectors on those codes, and the rerank recomputes the
+# exact distances of a pool of the best of them (RERANK_FACTOR * k by
+# default) from the full matrix, so the rounding of the codes can only
+# lose an image when it pushes it out of the pool.
+
+import numpy as np
+from DistanceEngine import top_k
+
+# rows per block when assigning vectors to centroids
+BLOCK_ROWS = 16384
+
+# candidates reranked with the exact distance, per result
+RERANK_FACTOR = 4
+
+
+# Per feature (min, step) of the one byte codes of the matrix.
+def quantizer(features):
+    low = features.min(axis=0).astype(np.float32)
+    step = ((features.max(axis=0) - low) / 255).astype(np.float32)
+    step[step == 0] = 1
+    return low, step
+
+
+# The one byte codes of the rows.
+def quantize(vectors, low, step):
+    return np.clip(np.rint((vectors - low) / step), 0, 255).astype(np.uint8)
+
+
+# Index of the nearest centroid (euclidean) of every row.
+def assign(vectors, centroids):
+    centroid_norms = (centroids ** 2).sum(axis=1)
+    labels = np.empty(len(vectors), dtype=np.int64)
+    for start in range(0, len(vectors), BLOCK_ROWS):
+        block = vectors[start:start + BLOCK_ROWS]
+        # |x - c|^2 without the |x|^2 term, which is the same for every centroid
+        scores = centroid_norms - 2 * (block @ centroids.T)
+        labels[start:start + len(block)] = scores.argmin(axis=1)
+    return labels
+
+
+# k-means on a sample of the rows. Returns the centroids.
+def train_centroids(vectors, nlist, iterations=10, sample_size=None, seed=0):
+    rng = np.random.default_rng(seed)
+    if sample_size is None:
+        sample_size = nlist * 32
+    if len(vectors) > sample_size:
+        sample = vectors[np.sort(rng.choice(len(vectors), sample_size, replace=False))]
+    else:
+        sample = vectors
+    sample = np.asarray(sample, dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(iterations):
+        labels = assign(sample, centroids)
+        counts = np.bincount(labels, minlength=nlist)
+        filled = counts > 0
+        # sum the rows of each partition, with the rows sorted by partition
+        order = np.argsort(labels, kind="stable")
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[filled]
+        sums = np.add.reduceat(sample[order], starts, axis=0)
+        centroids[filled] = sums / counts[filled, None]
+        # restart empty partitions from random rows
+        empty = np.flatnonzero(~filled)
+        if len(empty):
+            centroids[empty] = sample[rng.choice(len(sample), len(empty), replace=False)]
+    return centroids
+
+
+class AnnIndex:
+    # Constructor. features is the (images x features) matrix to index,
+    # usually DistanceEngine.get_matrix("inten_color_method").
+    # nlist is the number of partitions, sqrt(images) by default.
+    def __init__(self, features, nlist=None, iterations=10, seed=0):
+        features = np.asarray(features)
+        count = len(features)
+        if nlist is None:
+            nlist = int(np.sqrt(count))
+        nlist = max(1, min(nlist, count))
+
+        self.centroids = train_centroids(features, nlist, iterations, seed=seed)
+        labels = np.empty(count, dtype=np.int64)
+        for start in range(0, count, BLOCK_ROWS):
+            labels[start:start + BLOCK_ROWS] = assign(np.asarray(features[start:start + BLOCK_ROWS],
+                                                                 dtype=np.float32), self.centroids)
+
+        # The codes are stored partition by partition, so a partition is
+        # one contiguous slice. ids maps a stored row back to its image.
+        self.ids = np.argsort(labels, kind="stable")
+        self.low, self.step = quantizer(features)
+        self.codes = np.empty((count, features.shape[1]), dtype=np.uint8)
+        for start in range(0, count, BLOCK_ROWS):
+            rows = self.ids[start:start + BLOCK_ROWS]
+            self.codes[start:start + len(rows)] = quantize(features[rows], self.low, self.step)
+        self.offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(labels, minlength=nlist), out=self.offsets[1:])
+        self.features = features
+        self.nlist = nlist
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Returns (image ids, distances) of about the k closest images to the
+    # query vector, closest first.
+    # nprobe is how many partitions are scanned.
+    # rerank, if set, is how many of the best candidates get their exact
+    # distance from the full matrix before the final top k is taken
+    # (rerank=True means RERANK_FACTOR * k). Without it the distances are
+    # the ones of the codes.
+    def search(self, query, weights, k=10, nprobe=8, rerank=None):
+        query = np.asarray(query, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)[:len(query)]
+        nprobe = max(1, min(nprobe, self.nlist))
+
+        # the partitions with the closest centroids
+        centroid_distances = np.abs(self.centroids - query) @ weights
+        probe = top_k(centroid_distances, nprobe)
+
+        rows = np.concatenate([np.arange(self.offsets[p], self.offsets[p + 1]) for p in probe])
+        candidates = self.ids[rows]
+        # |low + code * step - query| = step * |code - (query - low) / step|
+        query_codes = ((query - self.low) / self.step).astype(np.float32)
+        distances = np.abs(self.codes[rows] - query_codes) @ (weights * self.step).astype(np.float32)
+
+        if rerank:
+            keep = RERANK_FACTOR * k if rerank is True else max(k, rerank)
+            best = top_k(distances, keep)
+            candidates = candidates[best]
+            distances = np.abs(self.features[candidates] - query) @ weights
+
+        best = top_k(distances, k)
+        # top_k breaks ties by position, use the image ids instead
+        order = np.lexsort((candidates[best], distances[best]))
+        best = best[order]
+        return candidates[best], distances[best].astype(np.float64)
+
+    # Fraction of the exact top k the index finds for the query.
+    def recall(self, query, weights, k=10, nprobe=8, rerank=None):
+        exact = top_k(np.abs(self.features - query) @ np.asarray(weights)[:len(query)], k)
+        found, _ = self.search(query, weights, k, nprobe, rerank)
+        return len(np.intersect1d(exact, found)) / max(1, min(k, len(exact)))
@@ -0,0 +1,111 @@
+# BackgroundWorker.py
+# Runs slow jobs (queries, relevance feedback) off the Tk thread.
+#
+# Jobs run one at a time, in the order they were submitted, on a single
+# worker thread. Their results are handed back to the Tk thread, which
+# polls for them with master.after, so callbacks can touch widgets.
+#
+# A job can be given a key; a newer job with the same key supersedes the
+# older one. If the older one has not started yet it is skipped, if it is
+# running it is asked to stop (its function gets a cancelled() callable to
+# check), and its result is dropped either way.
+
+import queue, threading
+
+
+class Job:
+    # Constructor.
+    def __init__(self, key, function, on_done, on_error):
+        self.key = key
+        self.function = function
+        self.on_done = on_done
+        self.on_error = on_error
+        self.stopped = threading.Event()
+
+    def cancel(self):
+        self.stopped.set()
+
+    def cancelled(self):
+        return self.stopped.is_set()
+
+
+class BackgroundWorker:
+    # Constructor. on_busy(busy) is called on the Tk thread when the worker
+    # starts having jobs and when it has none left, e.g. to show progress.
+    def __init__(self, master, on_busy=None, poll_ms=50):
+        self.master = master
+        self.on_busy = on_busy
+        self.poll_ms = poll_ms
+        self.jobs = queue.Queue()
+        self.finished = queue.Queue()
+        # key -> newest job with that key
+        self.latest = {}
+        self.pending = 0
+        self.polling = False
+        self.thread = threading.Thread(target=self.run, name="background-worker", daemon=True)
+        self.thread.start()
+
+    # Queues function(cancelled) and returns its Job. on_done(result) or
+    # on_error(exception) is called on the Tk thread when it finishes,
+    # unless a newer job with the same key superseded it. key=None jobs
+    # are never superseded.
+    def submit(self, function, key=None, on_done=None, on_error=None):
+        job = Job(key, function, on_done, on_error)
+        if key is not None:
+            older = self.latest.get(key)
+            if older is not None:
+                older.cancel()
+            self.latest[key] = job
+        self.jobs.put(job)
+        self.pending += 1
+        if not self.polling:
+            self.polling = True
+            if self.on_busy is not None:
+                self.on_busy(True)
+            self.master.after(self.poll_ms, self.poll)
+        return job
+
+    # Worker thread.
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            result = error = None
+            if not job.cancelled():
+                try:
+                    result = job.function(job.cancelled)
+                except Exception as e:
+                    error = e
+            self.finished.put((job, result, error))
+
+    # Tk thread: hands the finished jobs to their callbacks.
+    def poll(self):
+        while True:
+            try:
+                job, result, error = self.finished.get_nowait()
+            except queue.Empty:
+                break
+            self.pending -= 1
+            if job.key is not None and self.latest.get(job.key) is job:
+                del self.latest[job.key]
+            if job.cancelled():
+                continue
+            if error is not None:
+                if job.on_error is not None:
+                    job.on_error(error)
+                else:
+                    self.master.report_callback_exception(type(error), error, error.__traceback__)
+            elif job.on_done is not None:
+                job.on_done(result)
+
+        if self.pending:
+            self.master.after(self.poll_ms, self.poll)
+            return
+        self.polling = False
+        if self.on_busy is not None:
+            self.on_busy(False)
+
+    # Stops the worker thread once the queued jobs are done.
+    def stop(self):
+        self.jobs.put(None)
@@ -0,0 +1,295 @@
+# Benchmark.py
+# Performance benchmarks for the hot paths, on a synthetic corpus.
+#
+# python ./python/Benchmark.py --images 10000 --output bench.json
+# python ./python/Benchmark.py --images 10000 --compare bench.json
+#
+# A corpus of random JPEGs is generated in a temporary folder (with a
+# fixed seed, so runs are comparable). Only --jpeg-limit distinct JPEGs are
+# written and encoded; bigger corpora are filled with links to them, and
+# their bins are jittered copies of the encoded ones. The benchmark reports:
+# - encode throughput of intensity_method, color_code_method and encode,
+#   and of decoding and encoding files, at full size and in JPEG draft mode
+# - index build time (Indexer) for the distinct JPEGs
+# - startup time of PixInfo and calculate_normalized_feat_matrix time
+# - p50/p99 latency of find_distance-style queries in all three modes
+#   (and of the same queries with the exact pruned search)
+# - recall and latency of the cascade search for a few shortlist sizes
+# - time per update_weights (relevance feedback) round
+# The results are written as JSON. --compare reports the ratio of every
+# timing to a previous run and exits with 1 if one got slower than
+# --threshold.
+
+import argparse, json, os, platform, shutil, sys, tempfile, time
+from datetime import datetime, timezone
+import numpy as np
+from PIL import Image
+from PixInfo import PixInfo, get_joint_table, scale_counts, DRAFT_SCALES
+from Indexer import Indexer
+from FeatureStore import FeatureStore
+from Retrieval import RetrievalEngine
+from DistanceEngine import METHODS
+
+
+def percentile_ms(samples, q):
+    return float(np.percentile(samples, q) * 1000)
+
+
+# Writes count random JPEGs of the given size into image_dir, as 1.jpg,
+# 2.jpg, ... Smooth random color fields with noise, so they compress and
+# histogram like photos rather than like white noise.
+def generate_images(image_dir, count, width, height, seed):
+    rng = np.random.default_rng(seed)
+    os.makedirs(image_dir, exist_ok=True)
+    for i in range(count):
+        small = rng.integers(0, 256, (8, 12, 3), dtype=np.uint8)
+        im = Image.fromarray(small).resize((width, height), Image.BICUBIC)
+        noise = rng.integers(-12, 13, (height, width, 3))
+        pixels = np.clip(np.asarray(im, dtype=np.int16) + noise, 0, 255).astype(np.uint8)
+        Image.fromarray(pixels).save(os.path.join(image_dir, "%d.jpg" % (i + 1)), quality=90)
+
+
+# Fills the corpus up to total images with links to the distinct ones.
+def link_images(image_dir, distinct, total):
+    for i in range(distinct, total):
+        source = os.path.join(image_dir, "%d.jpg" % (i % distinct + 1))
+        target = os.path.join(image_dir, "%d.jpg" % (i + 1))
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+
+
+def time_calls(function, args_list):
+    start = time.perf_counter()
+    for args in args_list:
+        function(*args)
+    return time.perf_counter() - start
+
+
+def bench_encode(image_dir, count, repeat):
+    images = []
+    for i in range(count):
+        with Image.open(os.path.join(image_dir, "%d.jpg" % (i + 1))) as im:
+            images.append(im.convert("RGB"))
+    pixels = sum(im.size[0] * im.size[1] for im in images)
+    results = {"images": count}
+    # the lookup table of encode is made once per process, not per image
+    get_joint_table()
+    for name, function, make_args in (
+            ("intensity_method", PixInfo.intensity_method, lambda im: (im, im.size[0], im.size[1], [0] * 26)),
+            ("color_code_method", PixInfo.color_code_method, lambda im: (im, im.size[0], im.size[1], [0] * 65)),
+            ("encode", PixInfo.encode, lambda im: (im, im.size[0], im.size[1]))):
+        seconds = min(time_calls(function, [make_args(im) for im in images]) for _ in range(repeat))
+        results[name] = {
+            "seconds": seconds,
+            "images_per_second": count / seconds,
+            "megapixels_per_second": pixels / seconds / 1e6,
+        }
+    files = [os.path.join(image_dir, "%d.jpg" % (i + 1)) for i in range(count)]
+    for scale in DRAFT_SCALES:
+        seconds = min(time_calls(PixInfo.encode_file, [(f, scale) for f in files]) for _ in range(repeat))
+        results["encode_file_draft%d" % scale] = {
+            "seconds": seconds,
+            "images_per_second": count / seconds,
+        }
+    return results
+
+
+# Bins of the whole corpus: the encoded bins of the distinct images, and
+# jittered copies of them for the linked ones. The jittered color bins
+# are rescaled to add up to the pixel count of the jittered intensity
+# bins, like the bins of a real image.
+def corpus_bins(indexer, files, total, seed):
+    rng = np.random.default_rng(seed)
+    distinct = len(files)
+    intenCode = np.array([indexer.entries[f]["intensity"] for f in files], dtype=np.int64)
+    colorCode = np.array([indexer.entries[f]["color"][1:] for f in files], dtype=np.int64)
+    dims = np.array([indexer.entries[f]["dims"] for f in files], dtype=np.int64)
+    if total > distinct:
+        source = np.arange(distinct, total) % distinct
+        extra_inten = intenCode[source] + rng.integers(0, 4, (total - distinct, 26))
+        extra_inten[:, 0] = extra_inten[:, 1:].sum(axis=1)
+        extra_color = colorCode[source] + rng.integers(0, 4, (total - distinct, 64))
+        extra_color = scale_counts(extra_color, extra_inten[:, 0])
+        intenCode = np.vstack((intenCode, extra_inten))
+        colorCode = np.vstack((colorCode, extra_color))
+        dims = np.vstack((dims, dims[source]))
+    return intenCode, colorCode, dims
+
+
+def bench_queries(engine, queries, k, seed):
+    rng = np.random.default_rng(seed)
+    ids = rng.integers(0, len(engine), queries)
+    results = {}
+    for method, pruned in [(method, pruned) for pruned in (False, True) for method in METHODS]:
+        # one warm-up query builds the matrices (and page bounds) of the method
+        engine.query(int(ids[0]), method, k, pruned=pruned)
+        samples = []
+        for image_id in ids:
+            start = time.perf_counter()
+            engine.query(int(image_id), method, k, pruned=pruned)
+            samples.append(time.perf_counter() - start)
+        results[method + ("_pruned" if pruned else "")] = {
+            "queries": queries,
+            "k": k,
+            "p50_ms": percentile_ms(samples, 50),
+            "p99_ms": percentile_ms(samples, 99),
+            "mean_ms": float(np.mean(samples) * 1000),
+        }
+    return results
+
+
+# Recall against the full scan and mean latency of the cascade search
+# (see Cascade.py), for shortlists of 5, 10 and 25 times k.
+def bench_cascade(engine, queries, k, seed):
+    shortlists = [5 * k, 10 * k, 25 * k]
+    results, full_ms = engine.cascadeSearch.recall("inten_color_method", engine.pixInfo.weights, k,
+                                                   shortlists, queries, seed)
+    report = {"k": k, "full_scan_ms": full_ms}
+    for shortlist, result in results.items():
+        report["shortlist_%d" % shortlist] = result
+    return report
+
+
+def bench_feedback(engine, rounds, relevant, seed):
+    rng = np.random.default_rng(seed)
+    session = engine.new_session()
+    samples = []
+    for _ in range(rounds):
+        ids = [int(i) for i in rng.choice(len(engine), min(relevant + 1, len(engine)), replace=False)]
+        start = time.perf_counter()
+        engine.apply_feedback(ids[0], ids[1:], session)
+        samples.append(time.perf_counter() - start)
+    return {
+        "rounds": rounds,
+        "relevant_images": relevant,
+        "p50_ms": percentile_ms(samples, 50),
+        "p99_ms": percentile_ms(samples, 99),
+        "mean_ms": float(np.mean(samples) * 1000),
+    }
+
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix="cbir-bench-")
+    cwd = os.getcwd()
+    try:
+        # PixInfo and the Indexer work relative to the current folder
+        os.chdir(workdir)
+        distinct = min(args.images, args.jpeg_limit)
+        generate_images("images", distinct, args.width, args.height, args.seed)
+
+        report = {
+            "meta": {
+                "date": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "platform": platform.platform(),
+                "cpus": os.cpu_count(),
+                "images": args.images,
+                "distinct_jpegs": distinct,
+                "image_size": [args.width, args.height],
+                "seed": args.seed,
+            },
+        }
+        report["encode"] = bench_encode("images", min(distinct, args.encode_images), args.repeat)
+
+        indexer = Indexer(workers=args.workers)
+        start = time.perf_counter()
+        indexer.run(force=True)
+        index_seconds = time.perf_counter() - start
+        report["index_build"] = {"images": distinct, "seconds": index_seconds,
+                                 "images_per_second": distinct / index_seconds}
+
+        files = indexer.get_file_list()
+        link_images("images", distinct, args.images)
+        intenCode, colorCode, dims = corpus_bins(indexer, files, args.images, args.seed)
+        FeatureStore.write("features.bin", indexer.get_file_list(), intenCode, colorCode, dims)
+
+        start = time.perf_counter()
+        pixInfo = PixInfo()
+        startup_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        pixInfo.calculate_normalized_feat_matrix()
+        normalize_seconds = time.perf_counter() - start
+        start = time.perf_counter()
+        engine = RetrievalEngine(pixInfo, cache_size=0)
+        engine_seconds = time.perf_counter() - start
+        report["startup"] = {"pixinfo_seconds": startup_seconds, "engine_seconds": engine_seconds}
+        report["normalize"] = {"images": args.images, "seconds": normalize_seconds}
+
+        report["query"] = bench_queries(engine, args.queries, args.k, args.seed)
+        report["cascade"] = bench_cascade(engine, args.queries, args.k, args.seed)
+        report["feedback"] = bench_feedback(engine, args.feedback_rounds, args.relevant, args.seed)
+        return report
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+# Every timing of a report, as {"encode.encode.seconds": 1.2, ...}.
+# Throughputs are left out, they are the inverse of a timing.
+def timings(report, prefix=""):
+    found = {}
+    for key, value in report.items():
+        name = prefix + key
+        if isinstance(value, dict):
+            found.update(timings(value, name + "."))
+        elif key == "seconds" or key.endswith("_ms") or key.endswith("_seconds"):
+            found[name] = value
+    return found
+
+
+# Prints current / baseline for every timing both reports have. Returns
+# the names of the timings that are slower than the threshold allows.
+def compare(report, baseline, threshold):
+    current = timings(report)
+    previous = timings(baseline)
+    regressions = []
+    for name in sorted(set(current) & set(previous)):
+        if previous[name] <= 0:
+            continue
+        ratio = current[name] / previous[name]
+        flag = ""
+        if ratio > threshold:
+            flag = "  <-- slower"
+            regressions.append(name)
+        print("%-45s %12.4f %12.4f %7.2fx%s" % (name, previous[name], current[name], ratio, flag))
+    return regressions
+
+
+# Executable section.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark encoding, indexing, queries and feedback.")
+    parser.add_argument("--images", type=int, default=1000, help="corpus size")
+    parser.add_argument("--jpeg-limit", type=int, default=1000,
+                        help="distinct JPEGs to write, the rest of the corpus links to them")
+    parser.add_argument("--encode-images", type=int, default=100, help="images used for the encode benchmark")
+    parser.add_argument("--width", type=int, default=384)
+    parser.add_argument("--height", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200, help="queries per method")
+    parser.add_argument("-k", type=int, default=100, help="results per query")
+    parser.add_argument("--feedback-rounds", type=int, default=50)
+    parser.add_argument("--relevant", type=int, default=5, help="relevant images per feedback round")
+    parser.add_argument("--workers", type=int, default=None, help="indexer worker processes")
+    parser.add_argument("--repeat", type=int, default=3, help="encode repeats, the best one counts")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report to this file")
+    parser.add_argument("--compare", help="previous JSON report to compare with")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown ratio that counts as a regression")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare, "r") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print("%d timings regressed" % len(regressions))
+            sys.exit(1)
@@ -0,0 +1,144 @@
+# Cascade.py
+# Two-stage retrieval: a cheap scan shortlists, the full distance reranks.
+#
+# Run it from the top of the repo to see what the shortlist size costs in
+# recall and buys in time:
+# python ./python/Cascade.py --shortlist 50 100 200 -k 20 --queries 100
+#
+# The first stage scans a coarse copy of the matrix, where every group of
+# GROUP_SIZE adjacent features is summed into one (adjacent intensity bins
+# are close intensities, adjacent color codes differ in the blue bits, so
+# this is a coarser histogram). Each coarse feature is weighted with the
+# smallest weight of its group, which makes the coarse distance a lower
+# bound of the full one. The shortlist images with the smallest coarse
+# distances are then ranked with the full weighted distance of the method,
+# the current weights included.
+#
+# The coarse matrix is made once per index state and kept with it. The
+# result is exact when the true top k are all in the shortlist; recall()
+# measures how often they are, against the full scan.
+
+import argparse, time
+import numpy as np
+from DistanceEngine import METHODS, weighted_distances, top_k
+from Metrics import metrics
+
+# features summed into one coarse feature
+GROUP_SIZE = 4
+
+# images reranked with the full distance, by default
+SHORTLIST = 200
+
+
+# Sums every group_size adjacent columns of the matrix (the last group can
+# be smaller).
+def coarsen(matrix, group_size=GROUP_SIZE):
+    matrix = np.asarray(matrix, dtype=np.float64)
+    starts = np.arange(0, matrix.shape[-1], group_size)
+    return np.add.reduceat(matrix, starts, axis=-1)
+
+
+# Weight of every coarse feature, the smallest of its group.
+def coarse_weights(weights, group_size=GROUP_SIZE):
+    starts = np.arange(0, len(weights), group_size)
+    return np.minimum.reduceat(np.asarray(weights, dtype=np.float64), starts)
+
+
+class CascadeSearch:
+    # Constructor. distanceEngine gives the matrices and the index states.
+    def __init__(self, distanceEngine, shortlist=SHORTLIST, group_size=GROUP_SIZE):
+        self.distanceEngine = distanceEngine
+        self.shortlist = shortlist
+        self.group_size = group_size
+
+    # Coarse matrix of the method for the state, made the first time it is
+    # asked for and kept with the state.
+    def get_coarse(self, method, state):
+        key = ("coarse", method, self.group_size)
+        coarse = state.summaries.get(key)
+        if coarse is None:
+            with metrics.timer("cascade.coarsen"):
+                matrix = state.get_matrix(method)
+                coarse = np.empty((len(matrix), -(-matrix.shape[1] // self.group_size)), dtype=matrix.dtype)
+                for start in range(0, len(matrix), 16384):
+                    coarse[start:start + 16384] = coarsen(matrix[start:start + 16384], self.group_size)
+            state.summaries[key] = coarse
+        return coarse
+
+    # (indices, distances) of the k closest images to the query image,
+    # closest first, like DistanceEngine.query but only the shortlist
+    # (the search's by default) is ranked with the full distance.
+    def query(self, query_index, method, weights, k=None, state=None, shortlist=None):
+        state = state or self.distanceEngine.current()
+        return self.query_vector(state.get_matrix(method)[query_index], method, weights, k, state, shortlist)
+
+    def query_vector(self, query, method, weights, k=None, state=None, shortlist=None):
+        state = state or self.distanceEngine.current()
+        matrix = state.get_matrix(method)
+        weights = np.asarray(weights, dtype=np.float64)[:matrix.shape[1]]
+        query = np.asarray(query, dtype=np.float64)
+        shortlist = max(shortlist or self.shortlist, k or 0)
+        if k is None or shortlist >= len(matrix):
+            # the shortlist would be the whole corpus
+            return self.distanceEngine.query_vector(query, method, weights, k, state=state)
+
+        with metrics.timer("cascade.coarse"):
+            coarse = self.get_coarse(method, state)
+            candidates = top_k(weighted_distances(coarse, coarsen(query, self.group_size),
+                                                  coarse_weights(weights, self.group_size)), shortlist)
+        with metrics.timer("cascade.rerank"):
+            candidates = np.sort(candidates)
+            distances = weighted_distances(matrix[candidates], query, weights)
+            best = top_k(distances, k)
+        metrics.count("distances_computed", len(matrix) + len(candidates))
+        return candidates[best], distances[best]
+
+    # Recall of the cascade against the full scan: the part of the true
+    # top k found, over random query images, for every shortlist size.
+    # Returns {shortlist: {"recall", "mean_ms"}} and the mean time of the
+    # full scan in ms.
+    def recall(self, method, weights, k, shortlists, queries=100, seed=0):
+        state = self.distanceEngine.current()
+        ids = np.random.default_rng(seed).integers(0, len(state), queries)
+        exact = []
+        start = time.perf_counter()
+        for image_id in ids:
+            exact.append(set(self.distanceEngine.query(int(image_id), method, weights, k, state=state)[0].tolist()))
+        full_ms = (time.perf_counter() - start) / queries * 1000
+
+        # one warm-up query makes the coarse matrix
+        self.query(int(ids[0]), method, weights, k, state)
+        results = {}
+        for shortlist in shortlists:
+            found = 0
+            start = time.perf_counter()
+            for image_id, truth in zip(ids, exact):
+                indices = self.query(int(image_id), method, weights, k, state, shortlist)[0]
+                found += len(truth.intersection(indices.tolist()))
+            results[shortlist] = {
+                "recall": found / float(sum(len(truth) for truth in exact)),
+                "mean_ms": (time.perf_counter() - start) / queries * 1000,
+            }
+        return results, full_ms
+
+
+# Executable section.
+if __name__ == '__main__':
+    from PixInfo import PixInfo
+    from DistanceEngine import DistanceEngine
+
+    parser = argparse.ArgumentParser(description="Recall and speed of the cascade search against the full scan.")
+    parser.add_argument("--method", default="inten_color_method", choices=METHODS)
+    parser.add_argument("--shortlist", type=int, nargs="+", default=[50, 100, SHORTLIST, 500])
+    parser.add_argument("-k", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--group-size", type=int, default=GROUP_SIZE)
+    args = parser.parse_args()
+
+    pixInfo = PixInfo()
+    cascade = CascadeSearch(DistanceEngine(pixInfo), group_size=args.group_size)
+    results, full_ms = cascade.recall(args.method, pixInfo.weights, args.k, args.shortlist, args.queries)
+    print("%-10s %8s %10s" % ("shortlist", "recall", "mean ms"))
+    print("%-10s %8.3f %10.3f" % ("full scan", 1.0, full_ms))
+    for shortlist, result in sorted(results.items()):
+        print("%-10d %8.3f %10.3f" % (shortlist, result["recall"], result["mean_ms"]))
@@ -0,0 +1,196 @@
+# DistanceEngine.py
+# Weighted Manhattan distance from one query image to the whole corpus.
+#
+# The bins of every method are kept as one dense matrix, already divided
+# by the image sizes, so a query is one vectorized pass over the matrix
+# instead of a Python loop over every image and every bin.
+
+from contextlib import nullcontext
+import numpy as np
+from Metrics import metrics
+
+METHODS = ("color_code_method", "intensity_method", "inten_color_method")
+
+# rows per block when scanning the corpus
+BLOCK_ROWS = 4096
+
+# dtype of the size-normalized matrices
+MATRIX_DTYPE = np.float32
+
+
+# Raised when a query is cancelled before it is done.
+class QueryCancelled(Exception):
+    pass
+
+
+# Indices of the k smallest distances, closest first. Ties are broken by
+# image index, which is the order a stable full sort gives.
+def top_k(distances, k):
+    count = len(distances)
+    if k is None or k >= count:
+        return np.lexsort((np.arange(count), distances))
+    if k <= 0:
+        return np.zeros(0, dtype=np.intp)
+    part = np.argpartition(distances, k - 1)[:k]
+    kth = distances[part].max()
+    # everything tied with the k-th distance is a candidate, so the
+    # ties that make it in are the ones with the lowest index
+    candidates = np.flatnonzero(distances <= kth)
+    order = np.lexsort((candidates, distances[candidates]))
+    return candidates[order[:k]]
+
+
+# Bins divided by the image sizes, stored as MATRIX_DTYPE. The division is
+# done in float64, so a query vector made the same way is bit for bit the
+# row of its image.
+def size_normalize(bins, sizes):
+    return (np.asarray(bins, dtype=np.float64) / sizes).astype(MATRIX_DTYPE)
+
+
+# Weighted Manhattan distance between the query vector and every row of
+# the matrix, using the first matrix.shape[1] weights, a block of rows at
+# a time. cancelled is checked before every block. query can also be a
+# (queries, features) array, the result is then (queries, rows), a block
+# of rows against all the queries at once; block_rows should then be
+# smaller so the (queries, block_rows, features) buffer stays small. Every
+# query gets the distances it gets alone, bit for bit, as long as
+# block_rows is a multiple of 4.
+def weighted_distances(matrix, query, weights, cancelled=None, block_rows=BLOCK_ROWS):
+    weights = np.asarray(weights, dtype=np.float64)[:matrix.shape[1]]
+    query = np.array(query, dtype=np.float64)
+    queries = query.reshape(-1, matrix.shape[1])
+    out = np.empty((len(queries), len(matrix)))
+    buffer = np.empty((len(queries), min(block_rows, len(matrix)), matrix.shape[1]))
+    for start in range(0, len(matrix), block_rows):
+        if cancelled is not None and cancelled():
+            raise QueryCancelled()
+        block = matrix[start:start + block_rows]
+        diff = buffer[:, :len(block)]
+        np.subtract(block, queries[:, None, :], out=diff)
+        np.abs(diff, out=diff)
+        np.matmul(diff, weights, out=out[:, start:start + len(block)])
+    return out[0] if query.ndim == 1 else out
+
+
+# One published version of the index: the size-normalized matrix of every
+# method, with the file list, the normalized feature matrix (for relevance
+# feedback) and the column statistics they were built from. A state is
+# never changed after it is published; a new corpus version gets a new
+# state, so a query that took a state keeps reading a consistent index
+# while a newer one is built.
+class IndexState:
+    def __init__(self, version, matrices, fileList, column_avgs, column_stds, features=None):
+        self.version = version
+        self.matrices = matrices
+        self.fileList = fileList
+        self.features = features
+        self.column_avgs = column_avgs
+        self.column_stds = column_stds
+        # data derived from the matrices by the searches, e.g. the page
+        # bounds of PrunedSearch, made when first needed
+        self.summaries = {}
+
+    def __len__(self):
+        return len(self.fileList)
+
+    def get_matrix(self, method):
+        if method not in self.matrices:
+            raise ValueError("unknown method %r, expected one of %s" % (method, ", ".join(METHODS)))
+        return self.matrices[method]
+
+
+class DistanceEngine:
+    # Constructor. Builds the size-normalized matrix of each method from
+    # the bins PixInfo loaded.
+    def __init__(self, pixInfo):
+        self.pixInfo = pixInfo
+        self.state = None
+        self.refresh()
+
+    @property
+    def version(self):
+        return self.state.version
+
+    @property
+    def matrices(self):
+        return self.state.matrices
+
+    # Rebuilds the matrices from pixInfo and publishes them as a new state.
+    # It happens by itself when the corpus version of pixInfo changes
+    # (images added or removed, normalization refreshed). pixInfo is
+    # locked meanwhile, so a writer can't change it halfway.
+    def refresh(self):
+        with getattr(self.pixInfo, "lock", None) or nullcontext():
+            # every bin is divided by the size of its image, like find_distance
+            # always did (the thumbnail size from get_image_sizes).
+            sizes = np.asarray(self.pixInfo.get_image_sizes(), dtype=np.float64)[:, None]
+            features = self.pixInfo.get_normalized_feature()
+            bins = {
+                "color_code_method": self.pixInfo.get_colorCode(),
+                "intensity_method": self.pixInfo.get_intenCode(),
+                "inten_color_method": features,
+            }
+            matrices = {}
+            for method, matrix in bins.items():
+                matrices[method] = size_normalize(matrix, sizes)
+            self.state = IndexState(getattr(self.pixInfo, "corpus_version", 0), matrices,
+                                    list(self.pixInfo.get_file_list()),
+                                    np.array(self.pixInfo.column_avgs, dtype=np.float64),
+                                    np.array(self.pixInfo.column_stds, dtype=np.float64),
+                                    # a copy, pixInfo renormalizes its own in place
+                                    np.array(features, dtype=np.float32))
+        return self.state
+
+    # The latest published state. If the corpus changed since, it is
+    # brought up to date first, unless a writer holds pixInfo: then the
+    # published state is returned right away, readers never wait for a
+    # writer.
+    def current(self):
+        state = self.state
+        if getattr(self.pixInfo, "corpus_version", 0) != state.version:
+            lock = getattr(self.pixInfo, "lock", None)
+            if lock is None:
+                return self.refresh()
+            if lock.acquire(blocking=False):
+                try:
+                    state = self.refresh()
+                finally:
+                    lock.release()
+        return state
+
+    def get_matrix(self, method, state=None):
+        return (state or self.current()).get_matrix(method)
+
+    # Weighted Manhattan distance between the query image and every image,
+    # using the first len(bins) weights. The corpus is walked in blocks of
+    # rows so the temporary difference matrix stays small.
+    # cancelled, if given, is checked before every block; when it returns
+    # True the scan stops with QueryCancelled. state is the IndexState to
+    # read, the current one by default.
+    def distances(self, query_index, method, weights, cancelled=None, state=None):
+        state = state or self.current()
+        return self.distances_to(state.get_matrix(method)[query_index], method, weights, cancelled, state)
+
+    # Same as distances, for a query vector that is not in the corpus (it
+    # must already be divided by the image size like the matrix rows).
+    def distances_to(self, query, method, weights, cancelled=None, state=None):
+        matrix = self.get_matrix(method, state)
+        with metrics.timer("rank.distances"):
+            out = weighted_distances(matrix, query, weights, cancelled)
+        metrics.count("distances_computed", len(matrix))
+        return out
+
+    # Returns (indices, distances) of the k closest images to the query,
+    # closest first. k=None ranks the whole corpus.
+    def query(self, query_index, method, weights, k=None, cancelled=None, state=None):
+        distances = self.distances(query_index, method, weights, cancelled, state)
+        with metrics.timer("rank.select"):
+            indices = top_k(distances, k)
+        return indices, distances[indices]
+
+    # query for a vector that is not in the corpus, see distances_to.
+    def query_vector(self, query, method, weights, k=None, cancelled=None, state=None):
+        distances = self.distances_to(query, method, weights, cancelled, state)
+        with metrics.timer("rank.select"):
+            indices = top_k(distances, k)
+        return indices, distances[indices]
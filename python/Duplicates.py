@@ -0,0 +1,361 @@
+# Duplicates.py
+# Near-duplicate detection: which images are copies of each other.
+#
+# Run it from the top of the repo:
+# python ./python/Duplicates.py --report
+# python ./python/Duplicates.py --find some/new/image.jpg
+#
+# The signature of an image is its color code and intensity histograms
+# divided by the pixel count, so a resized or re-encoded copy gets almost
+# the same signature, and two images are duplicates when the L1 distance
+# between their signatures is at most the threshold (0 to 4, 0.5 by
+# default: copies resized to a quarter and re-encoded stay under it, and
+# distinct photos are well above it). Histograms can't tell apart two
+# photos with the same colors, e.g. two planes on the same gray sky; a
+# lower threshold finds fewer of those and fewer of the farther copies.
+#
+# Signatures are hashed into buckets with locality-sensitive hashing for
+# L1 (random Cauchy projections, quantized). Every image gets one bucket
+# key per table (the tables parameter, 64 by default), and each key mixes
+# the quantized values of several projections (the hashes parameter, 6
+# by default). Close signatures share a bucket in at least one table with
+# a high probability and far ones rarely do. A lookup only compares the
+# signature with the images of its buckets, however big the corpus is.
+# More tables find more of the farther copies, more hashes per table make
+# the buckets smaller. The groups report collects the pairs of images
+# that share a bucket in any table, each pair once, and computes their
+# distances in bulk.
+#
+# Removed images are only marked as removed, and left out of the
+# lookups; they are dropped for good once they are a quarter of the index.
+#
+# The Indexer builds the index the first time and saves it to
+# duplicates.npz; later runs, and the watcher of the server, load it and
+# only insert the images that were added or changed (the Indexer reports
+# the ones that look like an image already there).
+
+import argparse, os
+import numpy as np
+from FeatureStore import RowBuffer
+
+FEATURES = 64 + 25
+
+THRESHOLD = 0.5
+
+# signatures hashed at a time
+BLOCK_ROWS = 16384
+
+# pairs compared at a time by groups
+BLOCK_PAIRS = 65536
+
+
+# Signature of one image, from the CcBins and InBins of PixInfo.encode
+# (the pixel count first).
+def signature(CcBins, InBins):
+    CcBins = np.asarray(CcBins, dtype=np.float64)
+    InBins = np.asarray(InBins, dtype=np.float64)
+    return signatures(CcBins[None, 1:], InBins[None, :])[0]
+
+
+# Signatures of many images, from the color code bins (64 per image) and
+# the intensity bins (pixel count and 25 bins per image) PixInfo keeps.
+def signatures(colorCode, intenCode):
+    colorCode = np.asarray(colorCode, dtype=np.float64).reshape(-1, 64)
+    intenCode = np.asarray(intenCode, dtype=np.float64).reshape(-1, 26)
+    total = np.maximum(intenCode[:, :1], 1)
+    return np.hstack((colorCode / total, intenCode[:, 1:] / total)).astype(np.float32)
+
+
+# Every pair of positions (left < right) inside the runs from starts to
+# ends, as two arrays of positions.
+def run_pairs(starts, ends):
+    sizes = ends - starts
+    positions = np.repeat(starts, sizes) + np.arange(sizes.sum()) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    # how many positions follow every position in its run
+    later = np.repeat(ends, sizes) - positions - 1
+    left = np.repeat(positions, later)
+    # 1, 2, ... later[p] after every position p
+    offsets = np.arange(len(left)) - np.repeat(np.cumsum(later) - later, later) + 1
+    return left, left + offsets
+
+
+# The values of the arrays, sorted, every value once (a sort and a look
+# at the neighbor is much faster than np.unique).
+def unique_values(arrays):
+    values = np.sort(np.concatenate(arrays))
+    if len(values) < 2:
+        return values
+    return values[np.r_[True, values[1:] != values[:-1]]]
+
+
+# Groups of the images 0 to count - 1 linked by pairs, as sorted lists of
+# image ids, only the groups of more than one image.
+def connected_groups(count, pairs):
+    parent = list(range(count))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i, j in pairs:
+        root_i, root_j = find(int(i)), find(int(j))
+        if root_i != root_j:
+            parent[max(root_i, root_j)] = min(root_i, root_j)
+    groups = {}
+    for i in range(count):
+        groups.setdefault(find(i), []).append(i)
+    return sorted((group for group in groups.values() if len(group) > 1), key=lambda group: group[0])
+
+
+# The index saved at path, or None if there is none or it was made with
+# other parameters than params (the arguments of DuplicateIndex).
+def load_index(path, **params):
+    if not os.path.exists(path):
+        return None
+    try:
+        index = DuplicateIndex.load(path)
+    except (IOError, OSError, ValueError, KeyError) as e:
+        print("could not open %s: %s" % (path, e))
+        return None
+    wanted = DuplicateIndex(**params)
+    if index.params() != wanted.params():
+        return None
+    index.threshold = wanted.threshold
+    return index
+
+
+class DuplicateIndex:
+    # Constructor. The projections come from seed, so two indexes with the
+    # same parameters hash the same signature the same way.
+    def __init__(self, tables=64, hashes=6, width=1.5, threshold=THRESHOLD, seed=0):
+        self.tables = tables
+        self.hashes = hashes
+        self.width = width
+        self.threshold = threshold
+        self.seed = seed
+        rng = np.random.default_rng(seed)
+        self.projections = rng.standard_cauchy((FEATURES, tables * hashes))
+        self.offsets = rng.uniform(0, width, tables * hashes)
+        # odd multipliers that mix the hashes of a table into one key
+        self.mix = rng.integers(1, 2 ** 62, hashes, dtype=np.uint64) | np.uint64(1)
+        self.fileList = []
+        # file name -> image id, of the images not removed
+        self.ids = {}
+        self.removed = set()
+        self.signatures = RowBuffer([], np.float32, FEATURES)
+        self.keys = RowBuffer([], np.uint64, tables)
+        # per table (sorted keys, image ids in that order) of the first
+        # built images, the images added since are in recent
+        self.built = 0
+        self.sorted = None
+        self.recent = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    # What the hashing depends on: an index with other parameters is
+    # rebuilt, not added to.
+    def params(self):
+        return (self.tables, self.hashes, self.width, self.seed)
+
+    # Bucket key of every table, for every signature.
+    def bucket_keys(self, signatures):
+        signatures = np.asarray(signatures, dtype=np.float64).reshape(-1, FEATURES)
+        codes = np.floor((signatures @ self.projections + self.offsets) / self.width).astype(np.int64)
+        codes = codes.reshape(len(signatures), self.tables, self.hashes).astype(np.uint64)
+        return (codes * self.mix).sum(axis=2, dtype=np.uint64)
+
+    # Adds images, returns their ids. An image already in the index (by
+    # file name) is replaced.
+    def add(self, fileList, signatures):
+        fileList = list(fileList)
+        signatures = np.asarray(signatures, dtype=np.float32).reshape(-1, FEATURES)
+        for filename in fileList:
+            if filename in self.ids:
+                self.remove(filename)
+        start = len(self.fileList)
+        keys = np.empty((len(signatures), self.tables), dtype=np.uint64)
+        for block in range(0, len(signatures), BLOCK_ROWS):
+            keys[block:block + BLOCK_ROWS] = self.bucket_keys(signatures[block:block + BLOCK_ROWS])
+        self.fileList.extend(fileList)
+        self.ids.update((filename, i) for i, filename in enumerate(fileList, start))
+        self.signatures.extend(signatures)
+        self.keys.extend(keys)
+        if len(self.fileList) - self.built > max(1024, self.built // 4):
+            self.build()
+        else:
+            for image_id, row in enumerate(keys, start):
+                for table, key in enumerate(row.tolist()):
+                    self.recent.setdefault((table, key), []).append(image_id)
+        return list(range(start, len(self.fileList)))
+
+    # Removes the image, if it is in the index. The other ids only change
+    # when the removed images are dropped for good (see compact).
+    def remove(self, filename):
+        image_id = self.ids.pop(filename, None)
+        if image_id is None:
+            return
+        self.removed.add(image_id)
+        if len(self.removed) > max(1024, len(self.fileList) // 4):
+            self.compact()
+
+    # Drops the removed images, the ids of the others close up.
+    def compact(self):
+        keep = np.setdiff1d(np.arange(len(self.fileList)), np.fromiter(self.removed, dtype=np.intp))
+        self.fileList = [self.fileList[i] for i in keep]
+        self.ids = {filename: i for i, filename in enumerate(self.fileList)}
+        self.removed = set()
+        self.signatures = RowBuffer(self.signatures.array[keep], np.float32, FEATURES)
+        self.keys = RowBuffer(self.keys.array[keep], np.uint64, self.tables)
+        self.build()
+
+    # Sorts the bucket keys of every table, for the lookups.
+    def build(self):
+        keys = self.keys.array
+        self.sorted = []
+        for table in range(self.tables):
+            order = np.argsort(keys[:, table])
+            self.sorted.append((keys[order, table], order))
+        self.built = len(keys)
+        self.recent = {}
+
+    # Ids of the images that share a bucket with the keys.
+    def candidates(self, keys):
+        found = []
+        for table, key in enumerate(keys):
+            if self.sorted is not None:
+                table_keys, order = self.sorted[table]
+                start = np.searchsorted(table_keys, key, side="left")
+                stop = np.searchsorted(table_keys, key, side="right")
+                found.append(order[start:stop])
+            found.append(np.asarray(self.recent.get((table, int(key)), []), dtype=np.intp))
+        return np.unique(np.concatenate(found)) if found else np.zeros(0, dtype=np.intp)
+
+    # Images that look like the signature: (image id, file name, distance)
+    # of every image within the threshold (the index's by default), the
+    # closest first. exclude is an image id to leave out, e.g. its own.
+    def lookup(self, signature, threshold=None, exclude=None):
+        threshold = self.threshold if threshold is None else threshold
+        signature = np.asarray(signature, dtype=np.float32)
+        ids = self.candidates(self.bucket_keys(signature)[0])
+        if exclude is not None:
+            ids = ids[ids != exclude]
+        if self.removed:
+            ids = ids[~np.isin(ids, np.fromiter(self.removed, dtype=np.intp))]
+        distances = np.abs(self.signatures.array[ids] - signature).sum(axis=1, dtype=np.float64)
+        close = distances <= threshold
+        ids, distances = ids[close], distances[close]
+        order = np.lexsort((ids, distances))
+        return [(int(ids[i]), self.fileList[ids[i]], float(distances[i])) for i in order]
+
+    # Looks the image up, then adds it. Returns its id and what already
+    # looked like it (an older version of the same file is not counted).
+    def insert(self, filename, signature):
+        self.remove(filename)
+        matches = self.lookup(signature)
+        return self.add([filename], [signature])[0], matches
+
+    # Groups of images that are duplicates of each other (directly or
+    # through other copies), as lists of image ids.
+    def groups(self, threshold=None):
+        threshold = self.threshold if threshold is None else threshold
+        self.build()
+        signatures = self.signatures.array
+        count = len(self.fileList)
+        if count == 0:
+            return []
+        # the pairs that share a bucket in some table, as i * count + j
+        # with i < j, every pair once. A bucket with the same images as
+        # one of an earlier table (the sum of random numbers of its images
+        # tells) gives the same pairs and is skipped.
+        image_hashes = np.random.default_rng(self.seed).integers(0, 2 ** 63, count, dtype=np.uint64)
+        seen = set()
+        pairs = [np.zeros(0, dtype=np.int64)]
+        for table_keys, order in self.sorted:
+            starts = np.flatnonzero(np.r_[True, table_keys[1:] != table_keys[:-1]])
+            ends = np.r_[starts[1:], count]
+            shared = ends - starts > 1
+            starts, ends = starts[shared], ends[shared]
+            if not len(starts):
+                continue
+            buckets = zip(np.add.reduceat(image_hashes[order], starts).tolist(), (ends - starts).tolist())
+            new = np.zeros(len(starts), dtype=bool)
+            for run, bucket in enumerate(buckets):
+                if bucket not in seen:
+                    seen.add(bucket)
+                    new[run] = True
+            left, right = run_pairs(starts[new], ends[new])
+            i, j = order[left].astype(np.int64), order[right].astype(np.int64)
+            pairs.append(np.minimum(i, j) * count + np.maximum(i, j))
+        pairs = unique_values(pairs)
+        i, j = pairs // count, pairs % count
+        if self.removed:
+            removed = np.zeros(count, dtype=bool)
+            removed[np.fromiter(self.removed, dtype=np.intp)] = True
+            alive = ~(removed[i] | removed[j])
+            i, j = i[alive], j[alive]
+        close = np.zeros(len(i), dtype=bool)
+        for start in range(0, len(i), BLOCK_PAIRS):
+            stop = start + BLOCK_PAIRS
+            distances = np.abs(signatures[i[start:stop]] - signatures[j[start:stop]]).sum(axis=1, dtype=np.float64)
+            close[start:stop] = distances <= threshold
+        return connected_groups(count, zip(i[close], j[close]))
+
+    def save(self, path):
+        tmp = path + ".tmp.npz"
+        np.savez(tmp, params=np.array([self.tables, self.hashes, self.width, self.threshold, self.seed]),
+                 fileList=np.array(self.fileList, dtype=str), signatures=self.signatures.array,
+                 keys=self.keys.array, removed=np.array(sorted(self.removed), dtype=np.int64))
+        os.replace(tmp, path)
+
+    @staticmethod
+    def load(path):
+        with np.load(path) as data:
+            tables, hashes, width, threshold, seed = data["params"].tolist()
+            index = DuplicateIndex(int(tables), int(hashes), width, threshold, int(seed))
+            index.fileList = data["fileList"].tolist()
+            index.removed = set(data["removed"].tolist()) if "removed" in data.files else set()
+            index.ids = {filename: i for i, filename in enumerate(index.fileList) if i not in index.removed}
+            index.signatures = RowBuffer(data["signatures"], np.float32, FEATURES)
+            index.keys = RowBuffer(data["keys"], np.uint64, index.tables)
+        index.build()
+        return index
+
+    # Index of the images, from their bins.
+    @staticmethod
+    def from_bins(fileList, colorCode, intenCode, **params):
+        index = DuplicateIndex(**params)
+        index.add(list(fileList), signatures(colorCode, intenCode))
+        index.build()
+        return index
+
+
+# Executable section.
+if __name__ == '__main__':
+    from PixInfo import PixInfo
+
+    parser = argparse.ArgumentParser(description="Find near-duplicate images.")
+    parser.add_argument("--index", default="duplicates.npz", help="index saved by the Indexer")
+    parser.add_argument("--threshold", type=float, help="largest L1 distance between duplicates (0 to 4)")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--report", action="store_true", help="list the groups of duplicates in the corpus")
+    group.add_argument("--find", metavar="IMAGE", help="list the images of the corpus that look like IMAGE")
+    args = parser.parse_args()
+
+    if os.path.exists(args.index):
+        index = DuplicateIndex.load(args.index)
+    else:
+        pixInfo = PixInfo()
+        index = DuplicateIndex.from_bins(pixInfo.get_file_list(), pixInfo.get_colorCode(), pixInfo.get_intenCode())
+
+    if args.report:
+        groups = index.groups(args.threshold)
+        for group in groups:
+            print(" ".join(index.fileList[i] for i in group))
+        print("%d groups, %d images with a duplicate" % (len(groups), sum(len(group) for group in groups)))
+    else:
+        _, CcBins, InBins = PixInfo.encode_file(args.find)
+        for image_id, filename, distance in index.lookup(signature(CcBins, InBins), args.threshold):
+            print("%6d  %-30s %.4f" % (image_id, filename, distance))
@@ -0,0 +1,201 @@
+# FeatureStore.py
+# Binary, memory-mapped store for the histogram bins and the
+# normalized feature matrix.
+#
+# Layout (little endian, every section starts on an 8 byte boundary):
+#   header        magic, version, image count, bin counts, section offsets
+#   intensity     uint32 [count x 26]  (index 0 = total pixels)
+#   color code    uint32 [count x 64]
+#   dims          uint32 [count x 2]   (width, height)
+#   column avgs   float64 [89]
+#   column stds   float64 [89]
+#   features      float32 [count x 89] (normalized feature matrix)
+#   name offsets  uint64 [count + 1]
+#   names         utf-8 file names, back to back
+#
+# The file is opened read-only through a memory map, so opening it costs
+# the same for 100 or 1M images and processes that open the same store
+# share its pages.
+
+import os, struct
+from collections.abc import Sequence
+import numpy as np
+from Normalization import RunningStats, combine_bins
+
+MAGIC = b"CBIRFEAT"
+VERSION = 1
+INTENSITY_BINS = 26
+COLOR_CODE_BINS = 64
+FEATURES = 89
+
+# magic, version, count, intensity bins, color code bins, features,
+# then the offsets of the 8 sections.
+HEADER = struct.Struct("<8sIIIII8Q")
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+# Column averages, column standard deviations and the gaussian normalized
+# feature matrix of the combined bins, like
+# PixInfo.calculate_normalized_feat_matrix.
+def normalize_features(intenCode, colorCode):
+    features = combine_bins(intenCode, colorCode)
+    stats = RunningStats.from_matrix(features)
+    return stats.mean, stats.std(), stats.normalize(features)
+
+
+# Rows of a matrix that images can be appended to and deleted from.
+# Space is reserved ahead (doubling), so appending a row is O(row size)
+# on average. array is the filled part of the buffer.
+class RowBuffer:
+    def __init__(self, rows, dtype, width):
+        rows = np.asarray(rows, dtype=dtype).reshape(-1, width)
+        self.data = np.empty((max(2 * len(rows), 16), width), dtype=dtype)
+        self.data[:len(rows)] = rows
+        self.count = len(rows)
+
+    @property
+    def array(self):
+        return self.data[:self.count]
+
+    def append(self, row):
+        if self.count == len(self.data):
+            data = np.empty((2 * len(self.data), self.data.shape[1]), dtype=self.data.dtype)
+            data[:self.count] = self.array
+            self.data = data
+        self.data[self.count] = row
+        self.count += 1
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self.data.dtype).reshape(-1, self.data.shape[1])
+        if self.count + len(rows) > len(self.data):
+            data = np.empty((max(2 * len(self.data), self.count + len(rows)), self.data.shape[1]),
+                            dtype=self.data.dtype)
+            data[:self.count] = self.array
+            self.data = data
+        self.data[self.count:self.count + len(rows)] = rows
+        self.count += len(rows)
+
+    def delete(self, i):
+        self.data[i:self.count - 1] = self.data[i + 1:self.count]
+        self.count -= 1
+
+
+# Read-only list of file names backed by the names section of the store.
+# Names are decoded one at a time when they are asked for.
+class NameTable(Sequence):
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("name index out of range")
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode("utf-8")
+
+
+class FeatureStore:
+    # Constructor. Opens an existing store file.
+    def __init__(self, path):
+        self.path = path
+        self.buffer = np.memmap(path, dtype=np.uint8, mode="r")
+        if len(self.buffer) < HEADER.size:
+            raise ValueError("%s is not a feature store" % path)
+        header = HEADER.unpack(bytes(self.buffer[:HEADER.size]))
+        magic, version, count, inten_bins, color_bins, features = header[:6]
+        offsets = header[6:]
+        if magic != MAGIC:
+            raise ValueError("%s is not a feature store" % path)
+        if version != VERSION:
+            raise ValueError("%s has unsupported version %d" % (path, version))
+
+        self.count = count
+        self.intenCode = self._section(offsets[0], np.uint32, (count, inten_bins))
+        self.colorCode = self._section(offsets[1], np.uint32, (count, color_bins))
+        self.dims = self._section(offsets[2], np.uint32, (count, 2))
+        self.column_avgs = self._section(offsets[3], np.float64, (features,))
+        self.column_stds = self._section(offsets[4], np.float64, (features,))
+        self.feature_matrix = self._section(offsets[5], np.float32, (count, features))
+        name_offsets = self._section(offsets[6], np.uint64, (count + 1,))
+        self.fileList = NameTable(name_offsets, self.buffer[offsets[7]:])
+
+    def _section(self, offset, dtype, shape):
+        return np.ndarray(shape, dtype=dtype, buffer=self.buffer, offset=offset)
+
+    def __len__(self):
+        return self.count
+
+    # Writes a new store file. The file is written next to the target and
+    # renamed over it, so readers never see a half-written store.
+    @staticmethod
+    def write(path, fileList, intenCode, colorCode, dims,
+              column_avgs=None, column_stds=None, feature_matrix=None):
+        intenCode = np.asarray(intenCode, dtype=np.uint32).reshape(-1, INTENSITY_BINS)
+        colorCode = np.asarray(colorCode, dtype=np.uint32).reshape(-1, COLOR_CODE_BINS)
+        dims = np.asarray(dims, dtype=np.uint32).reshape(-1, 2)
+        count = len(intenCode)
+        if not (len(fileList) == len(colorCode) == len(dims) == count):
+            raise ValueError("file list, bins and dims must have one row per image")
+        if feature_matrix is None:
+            column_avgs, column_stds, feature_matrix = normalize_features(intenCode, colorCode)
+
+        names = [name.encode("utf-8") for name in fileList]
+        name_offsets = np.zeros(count + 1, dtype=np.uint64)
+        np.cumsum([len(name) for name in names], out=name_offsets[1:])
+
+        sections = [
+            intenCode,
+            colorCode,
+            dims,
+            np.asarray(column_avgs, dtype=np.float64).reshape(FEATURES),
+            np.asarray(column_stds, dtype=np.float64).reshape(FEATURES),
+            np.asarray(feature_matrix, dtype=np.float32).reshape(count, FEATURES),
+            name_offsets,
+        ]
+        offsets = []
+        offset = _align(HEADER.size)
+        for section in sections:
+            offsets.append(offset)
+            offset = _align(offset + section.nbytes)
+        offsets.append(offset)
+
+        tmp = path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, VERSION, count, INTENSITY_BINS, COLOR_CODE_BINS,
+                                FEATURES, *offsets))
+            for section, start in zip(sections, offsets):
+                f.write(b"\0" * (start - f.tell()))
+                f.write(np.ascontiguousarray(section).tobytes())
+            f.write(b"\0" * (offsets[-1] - f.tell()))
+            f.write(b"".join(names))
+        os.replace(tmp, path)
+
+
+# Executable section.
+# Builds features.bin from the existing intensity.txt and colorCodes.txt.
+if __name__ == '__main__':
+    import glob
+    from PIL import Image
+    from PixInfo import numericalSort
+
+    def read_rows(filename):
+        with open(filename, "r") as f:
+            return [[float(v) for v in line.split(",")] for line in f if line.strip()]
+
+    fileList = sorted(glob.glob('images/*.jpg'), key=numericalSort)
+    dims = []
+    for infile in fileList:
+        with Image.open(infile) as im:
+            dims.append(im.size)
+    FeatureStore.write("features.bin", fileList, read_rows("intensity.txt"),
+                       read_rows("colorCodes.txt"), dims)
+    print("Wrote features.bin with %d images" % len(fileList))
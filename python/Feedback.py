@@ -0,0 +1,74 @@
+# Feedback.py
+# Relevance feedback.
+#
+# The images marked as relevant (with the query image) are taken from the
+# normalized feature matrix, and every feature gets the weight
+# 1 / (std of that feature over the relevant images), normalized so the
+# weights add up to 1:
+# - if the std and the mean are 0, the weight is 0
+# - if the std is 0 and the mean is not, the std is taken as half of the
+#   smallest non-zero std
+#
+# A FeedbackSession holds the weights and the feedback rounds of one user,
+# so many users can run feedback at the same time against the same,
+# read-only feature matrix.
+
+import numpy as np
+
+FEATURES = 89
+
+
+# The initial weights, every feature counts the same. Weights are float32.
+def initial_weights(features=FEATURES):
+    return np.full(features, 1 / features, dtype=np.float32)
+
+
+# Feature weights from the rows of the relevant images. Only those rows
+# of the feature matrix are read.
+def feedback_weights(feature_matrix, relevant_imgs):
+    rows = np.asarray(feature_matrix[np.asarray(relevant_imgs, dtype=np.intp)], dtype=np.float64)
+    column_avgs = rows.mean(axis=0)
+    if len(rows) > 1:
+        column_stds = rows.std(axis=0, ddof=1)
+    else:
+        column_stds = np.zeros(rows.shape[1])
+
+    no_spread = column_stds == 0
+    nonzero = column_stds[~no_spread]
+    # with no spread in any column, the columns that are not 0 share the weight
+    fallback_std = nonzero.min() / 2 if len(nonzero) else 1.0
+    column_stds = np.where(no_spread, fallback_std, column_stds)
+
+    # updated weight for each column = 1/std of column
+    updated_weights = np.where(no_spread & (column_avgs == 0), 0, 1 / column_stds)
+    sum_of_cols = updated_weights.sum()
+    if sum_of_cols == 0:
+        return initial_weights(len(updated_weights))
+    # normalized weight of column = updated weight of column / sum of all updated columns weights
+    return (updated_weights / sum_of_cols).astype(np.float32)
+
+
+class FeedbackSession:
+    # Constructor. pixInfo gives the shared normalized feature matrix,
+    # the session never writes to it.
+    def __init__(self, pixInfo):
+        self.pixInfo = pixInfo
+        self.weights = initial_weights()
+        # one (relevant images, weights after the round) tuple per round
+        self.history = []
+
+    # A feedback round: the query image first, then the relevant images.
+    # feature_matrix is the normalized feature matrix to read the rows
+    # from, the one of pixInfo by default.
+    def update(self, relevant_imgs, feature_matrix=None):
+        relevant_imgs = list(relevant_imgs)
+        if feature_matrix is None:
+            feature_matrix = self.pixInfo.get_normalized_feature()
+        self.weights = feedback_weights(feature_matrix, relevant_imgs)
+        self.history.append((relevant_imgs, self.weights))
+        return self.weights
+
+    # Back to the initial weights, and forgets the rounds.
+    def reset(self):
+        self.weights = initial_weights()
+        self.history = []
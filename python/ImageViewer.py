@@ -6,25 +6,35 @@
 
 
 from tkinter import *
-import math, os
+from tkinter import ttk
+import argparse, math, os
 from PixInfo import PixInfo
+from Retrieval import RetrievalEngine
+from ResultsView import ResultsView
+from BackgroundWorker import BackgroundWorker
+from Metrics import metrics
 
 
 # Main app.
 class ImageViewer(Frame):
     # Constructor.
-    def __init__(self, master, pixInfo, resultWin):
+    # page_size results are shown per page, on up to pages pages.
+    def __init__(self, master, pixInfo, resultWin, page_size=20, pages=5):
 
         Frame.__init__(self, master)
         self.chosen_image = " "
+        self.chosen_index = 0
         self.master = master
         self.pixInfo = pixInfo
         self.resultWin = resultWin
         self.image_sizes = self.pixInfo.get_image_sizes()
         self.check_var = 0
         self.current_page = 0
+        self.page_size = page_size
         self.colorCode = pixInfo.get_colorCode()
         self.intenCode = pixInfo.get_intenCode()
+        self.engine = RetrievalEngine(pixInfo)
+        self.session = self.engine.new_session()
 
         # Full-sized images.
         self.imageList = pixInfo.get_imageList()
@@ -32,9 +42,6 @@ class ImageViewer(Frame):
         # file names of images
         self.fileList = pixInfo.get_file_list()
 
-        # Thumbnail sized images.
-        self.photoList = pixInfo.get_photoList()
-
         # Image size for formatting.
         self.xmax = pixInfo.get_xmax()
         self.ymax = pixInfo.get_ymax()
@@ -62,9 +69,6 @@ class ImageViewer(Frame):
         # Create Results frame.
         resultsFrame = Frame(self.resultWin)
         resultsFrame.pack(side=TOP)
-        self.canvas = Canvas(resultsFrame)
-        self.resultsScrollbar = Scrollbar(resultsFrame)
-        self.resultsScrollbar.pack(side=RIGHT, fill=Y)
 
         # Layout Picture Listbox.
         self.listScrollbar = Scrollbar(listFrame)
@@ -108,28 +112,36 @@ class ImageViewer(Frame):
                                       command=lambda: self.update_weights_procedure())
         self.submit_relevant.grid(row=6, sticky=EW)
 
+        # Shown while a query or feedback round runs in the background.
+        self.progress = ttk.Progressbar(controlFrame, mode='indeterminate')
+        self.progress.grid(row=7, sticky=EW)
+        self.progress.grid_remove()
+
+        # Queries and feedback run on a worker thread, so the window
+        # stays responsive. A new query supersedes the one still running.
+        self.worker = BackgroundWorker(master, on_busy=self.set_busy)
+
         # self.var = Checkbutton(controlFrame, text="Relevant", onvalue=1, offvalue=0)
         # self.check_list = []
 
         # Layout Preview.
+        self.chosen_image = self.pixInfo.get_photo(self.chosen_index)
         self.selectImg = Label(previewFrame,
-                               image=self.photoList[0], width=100)
+                               image=self.chosen_image, width=100)
         self.selectImg.grid(sticky='nesw', column=0, row=0)
 
-        # Initialize the canvas with dimensions equal to the
-        # number of results.
-        fullsize = (0, 0, (self.xmax * 50), (self.ymax * 50))
-        self.canvas.delete(ALL)
-        self.canvas.config(
-            width=self.xmax * 100,
-            height=self.ymax * 100 / 2,
-            yscrollcommand=self.resultsScrollbar.set,
-            scrollregion=fullsize)
-        self.canvas.pack(fill='both')
-        self.resultsScrollbar.config(command=self.canvas.yview)
+        # Results grid. Thumbnails are only made for the results in view.
+        cols = int(math.ceil(math.sqrt(page_size)))
+        self.resultsView = ResultsView(resultsFrame,
+                                       get_photo=self.pixInfo.get_photo,
+                                       on_click=self.inspect_pic,
+                                       tile_width=self.xmax,
+                                       tile_height=self.ymax,
+                                       cols=cols,
+                                       view_rows=cols / 2)
 
         # array of tuples
-        self.page_images = [None] * 5
+        self.page_images = [[] for _ in range(pages)]
 
         # buttons for the pages
         previous_button = Button(resultsFrame, text="Previous page",
@@ -146,43 +158,50 @@ class ImageViewer(Frame):
                                 font="Times 18 bold")
         self.page_label.pack(padx=100)
 
+    def set_busy(self, busy):
+        if busy:
+            self.progress.grid()
+            self.progress.start()
+        else:
+            self.progress.stop()
+            self.progress.grid_remove()
+
+    # Queued behind the queries and feedback rounds already submitted, so
+    # it never changes the weights under a running one.
     def reset_weights(self):
-        pixInfo.weights = [1/89] * 89
+        self.worker.submit(lambda cancelled: self.engine.reset_feedback(self.session))
         self.relevant_text.set('')
-        
+
+    # The relevant images are typed in as image numbers (the "Image n"
+    # in the list), the engine wants 0-based ids.
     def update_weights_procedure(self):
         raw_text = self.relevant_text.get()
-        str_list = raw_text.split(" ")
-        query_img_number = int(str(self.chosen_image)[7:])
-        relevant_list = [int(i) for i in str_list if i != '']
-        relevant_list.insert(0, query_img_number)
-        pixInfo.update_weights(relevant_imgs=relevant_list)
-
-    def get_relevant(self):
-        relevant = self.relevant_text.get()
-        self.relevant_list = relevant.split()
-        chosen_image_index = int(str(self.chosen_image)[7:]) - 1
-        self.relevant_list.insert(0, chosen_image_index)
-        int_array = [int(numeric_string) for numeric_string in relevant_list]
+        relevant_list = [int(i) - 1 for i in raw_text.split()]
+        chosen_index = self.chosen_index
+        self.worker.submit(
+            lambda cancelled: self.engine.apply_feedback(chosen_index, relevant_list, self.session))
 
     # Event "listener" for listbox change.
     def update_preview(self, event):
 
         i = self.list.curselection()[0]
-        self.chosen_image = self.photoList[int(i)]
+        self.chosen_index = int(i)
+        self.chosen_image = self.pixInfo.get_photo(self.chosen_index)
         self.selectImg.configure(
             image=self.chosen_image)
 
     def previous_page(self):
-        if self.current_page > 0:
-            self.current_page -= 1
-            self.page_label['text'] = "Page " + str(self.current_page + 1)
-        self.update_results()
+        self.show_page(self.current_page - 1)
 
     def next_page(self):
-        if self.current_page < 4:  # change hard-coded 6 to be len(imgs/# of imgs per page) later..
-            self.current_page += 1
-            self.page_label['text'] = "Page " + str(self.current_page + 1)
+        self.show_page(self.current_page + 1)
+
+    # Shows another page of results, if there is one.
+    def show_page(self, page):
+        if page == self.current_page or not 0 <= page < len(self.page_images) or not self.page_images[page]:
+            return
+        self.current_page = page
+        self.page_label['text'] = "Page " + str(self.current_page + 1)
         self.update_results()
 
     # Find the Manhattan Distance of each image and return a
@@ -193,52 +212,30 @@ class ImageViewer(Frame):
     # the "method" argument can have one of the two following values(as strings):
     # color_code_method
     # intensity_method
+    # The ranking runs on the worker thread and show_results puts it on
+    # screen when it is done, unless another query was started meanwhile.
     def find_distance(self, method):
-        # "chosen_image_index" is the index of the chosen image in the
-        # image list
-        chosen_image_index = int(str(self.chosen_image)[7:]) - 1
-        weights = []
-        bins_to_compare = []
-        if method == "color_code_method":
-            bins_to_compare = self.colorCode
-            for i in range(89):
-                weights.append(1)
-        elif method == "intensity_method":
-            bins_to_compare = self.intenCode
-            for i in range(89):
-                weights.append(1)
-        elif method == "inten_color_method":
-            bins_to_compare = pixInfo.get_normalized_feature()
-
-        # now apply the manhattan distance technique,
-        # compute the distance between the chosen index image
-        # and all other images
-        chosen_image_bin = bins_to_compare[chosen_image_index]
-
+        # now apply the manhattan distance technique, compute the distance
+        # between the chosen image and all other images, and keep
+        # only as many of the closest ones as the result pages can show.
+        k = len(self.page_images) * self.page_size
+        chosen_index = self.chosen_index
+        return self.worker.submit(
+            lambda cancelled: self.engine.query(chosen_index, method, k, session=self.session,
+                                                cancelled=cancelled),
+            key="query", on_done=self.show_results)
+
+    def show_results(self, results):
         image_info = []
-        for i in range(len(bins_to_compare)):
-            other_image_bin = bins_to_compare[i]
-            other_image_img = self.photoList[i]
-            other_image_file = self.fileList[i] # all the images file name
-
-            manhattan_distance = 0
-            if (i != chosen_image_index):
-                chosen_image_size = self.image_sizes[chosen_image_index]
-                other_image_size = self.image_sizes[i]
-                # iterate through the items in each bin
-                for j in range(len(chosen_image_bin)):
-                    chosen_image_bin_value = chosen_image_bin[j]
-                    other_image_bin_value = other_image_bin[j]
-                    manhattan_distance += pixInfo.weights[j] * abs(chosen_image_bin_value / chosen_image_size
-                                                                   - other_image_bin_value / other_image_size)
-
-            # tuple of the form (image, image file name, manhattan distance)
-            info = (other_image_img, other_image_file, manhattan_distance)
+        for i, filename, manhattan_distance in results:
+            # tuple of the form (image index, image file name, manhattan distance)
+            info = (i, filename, manhattan_distance)
             image_info.append(info)
 
-        # sort the image info by their manhattan distances
-        image_info.sort(key=lambda x: x[2])
+        # image info is already sorted by manhattan distance
         self.put_sorted_images_in_pages_array(image_info)
+        self.current_page = 0
+        self.page_label['text'] = "Page 1"
         self.update_results()
 
         return image_info
@@ -246,72 +243,15 @@ class ImageViewer(Frame):
     # places image info(image file name, image) into the page buckets that they belong to
     # in "self.page_images"
     def put_sorted_images_in_pages_array(self, image_info):
-        curr_index = 0
-        for i in range(0, 5):
-            page_image_info = []
-            for j in range(0, 20):
-                page_image_info.append(image_info[curr_index])
-                curr_index += 1
-            self.page_images[i] = (page_image_info)
-
-    # Update the results window with the sorted results.
-    def update_results(self):
+        for i in range(len(self.page_images)):
+            start = i * self.page_size
+            self.page_images[i] = image_info[start:start + self.page_size]
 
-        cols = int(math.ceil(math.sqrt(len(self.page_images[self.current_page]))))
-        fullsize = (0, 0, (self.xmax * cols), (self.ymax * (cols - 1)))
-
-        # Initialize the canvas with dimensions equal to the
-        # number of results.
-        self.canvas.delete(ALL)
-        self.canvas.config(
-            width=self.xmax * cols,
-            height=self.ymax * cols / 2,
-            yscrollcommand=self.resultsScrollbar.set,
-            scrollregion=fullsize)
-        self.canvas.pack()
-        self.resultsScrollbar.config(command=self.canvas.yview)
-
-        # photo remain is the list of photos to be placed
-        # each item in "photoRemain" is a tuple of the form
-        # (filename, img)
-        photoRemain = []
-
-        for photo_item in self.page_images[self.current_page]:
-            photo_file_name = photo_item[1]
-            photo_image = photo_item[0]
-            photoRemain.append((photo_file_name, photo_image))
-
-        # Place images on buttons, then on the canvas in order
-        # by distance.  Buttons envoke the inspect_pic method.
-        rowPos = 0
-        while photoRemain:
-            photoRow = photoRemain[:cols]
-            photoRemain = photoRemain[cols:]
-            colPos = 0
-            for (filename, img) in photoRow:
-                link = Button(self.canvas, image=img, text=filename)
-                handler = lambda f=filename: self.inspect_pic(f)
-                link.config(command=handler)
-                link.pack(side=LEFT, expand=YES)
-
-                self.canvas.create_window(
-                    colPos,
-                    rowPos,
-                    anchor=NW,
-                    window=link,
-                    width=self.xmax,
-                    height=self.ymax)
-
-                img_label = Label(link, text=filename[7:])
-                img_label.pack(side=BOTTOM)
-                # if self.var.getint() == 1:
-                #     img_checkbox = Checkbutton(link, text="Relevant", variable=self.relevant_list[self.counter])
-                #     img_checkbox.pack(side=BOTTOM)
-                # else:
-                #     self.relevant_list.clear()
-                # self.counter += 1
-                colPos += self.xmax
-            rowPos += self.ymax
+    # Update the results window with the sorted results. The tiles of the
+    # results view are reused, only their images and captions change.
+    def update_results(self):
+        with metrics.timer("render"):
+            self.resultsView.show(self.page_images[self.current_page])
 
     # Open the picture with the default operating system image
     # viewer.
@@ -321,6 +261,11 @@ class ImageViewer(Frame):
 
 # Executable section.
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Browse the images and their closest matches.")
+    parser.add_argument("--page-size", type=int, default=20, help="results per page")
+    parser.add_argument("--pages", type=int, default=5, help="pages of results")
+    args = parser.parse_args()
+
     root = Tk()
     root.title('Image Analysis Tool')
 
@@ -331,6 +276,6 @@ if __name__ == '__main__':
 
     pixInfo = PixInfo(root)
 
-    imageViewer = ImageViewer(root, pixInfo, resultWin)
+    imageViewer = ImageViewer(root, pixInfo, resultWin, args.page_size, args.pages)
 
     root.mainloop()
\ No newline at end of file
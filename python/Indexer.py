@@ -0,0 +1,262 @@
+# Indexer.py
+# Program to rebuild intensity.txt, colorCodes.txt and the binary
+# feature store (features.bin) from the images folder.
+#
+# Run it from the top of the repo, like the viewer:
+# python ./python/Indexer.py
+#
+# Images are decoded and histogrammed with PixInfo.encode on a pool of
+# worker processes. A manifest remembers the size, mtime and content hash
+# of every image with its bins, so a re-run only encodes the images that
+# were added or changed since the last one. The near-duplicate index
+# (duplicates.npz, see Duplicates.py) is updated the same way: the saved
+# one is loaded and only the encoded images are inserted (it is rebuilt
+# with --force, or when it was made with other parameters), and the new
+# images that look like another image are printed.
+#
+# --draft 2|4|8 decodes the JPEGs at 1/2, 1/4 or 1/8 of their size, for
+# faster bulk ingestion (see PixInfo.encode_file).
+# --drift-report N encodes N images both at full size and with --draft and
+# reports how far the normalized histograms drift, and how much faster the
+# draft decode is, without indexing anything.
+
+import argparse, glob, hashlib, json, os, time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import numpy as np
+from FeatureStore import FeatureStore
+from Duplicates import DuplicateIndex, load_index, signatures
+from PixInfo import PixInfo, numericalSort, get_joint_table, DRAFT_SCALES
+
+MANIFEST_VERSION = 1
+
+
+# Content hash of an image file, read in chunks so big files
+# don't have to fit in memory.
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Worker function. Hashes the file first, and only decodes it if the
+# hash differs from the one we already have bins for (known_hash).
+# Returns (path, hash, dims, CcBins, InBins), with None for the dims and
+# bins when the old ones can be reused.
+def encode_file(path, known_hash=None, draft_scale=1):
+    sha1 = file_hash(path)
+    if sha1 == known_hash:
+        return path, sha1, None, None, None
+    dims, CcBins, InBins = PixInfo.encode_file(path, draft_scale)
+    return path, sha1, list(dims), CcBins, InBins
+
+
+# Drift of the draft decode: encodes the files at full size and at
+# draft_scale, and returns the L1 distance between the normalized
+# histograms (bins / pixel count, so 0 is no drift and 2 is the most
+# there can be) of every descriptor, with the time of both encodes.
+def draft_drift(files, draft_scale):
+    drift = {"color": [], "intensity": []}
+    seconds = {1: 0.0, draft_scale: 0.0}
+    # the lookup table is made once, not on the clock
+    get_joint_table()
+    for path in files:
+        bins = {}
+        for scale in seconds:
+            start = time.perf_counter()
+            _, CcBins, InBins = PixInfo.encode_file(path, scale)
+            seconds[scale] += time.perf_counter() - start
+            bins[scale] = (np.array(CcBins[1:]) / CcBins[0], np.array(InBins[1:]) / InBins[0])
+        drift["color"].append(np.abs(bins[1][0] - bins[draft_scale][0]).sum())
+        drift["intensity"].append(np.abs(bins[1][1] - bins[draft_scale][1]).sum())
+
+    report = {"images": len(files), "draft_scale": draft_scale,
+              "full_seconds": seconds[1], "draft_seconds": seconds[draft_scale],
+              "speedup": seconds[1] / seconds[draft_scale] if seconds[draft_scale] else 0.0}
+    for name, values in drift.items():
+        report[name] = {"mean_l1": float(np.mean(values)),
+                        "p95_l1": float(np.percentile(values, 95)),
+                        "max_l1": float(np.max(values))}
+    return report
+
+
+# Writes one comma separated row of floats per image, in the
+# format readIntensityFile/readColorCodeFile expect.
+def write_bins_file(filename, rows):
+    tmp = filename + ".tmp"
+    with open(tmp, "w") as f:
+        for row in rows:
+            f.write(",".join(str(float(v)) for v in row) + "\n")
+    os.replace(tmp, filename)
+
+
+class Indexer:
+    # Constructor.
+    def __init__(self, image_dir="images", intensity_file="intensity.txt",
+                 color_code_file="colorCodes.txt", store_file="features.bin",
+                 manifest_file="index_manifest.json", workers=None, max_pending=None,
+                 draft_scale=1, duplicates_file="duplicates.npz", duplicate_params=None):
+        if draft_scale not in DRAFT_SCALES:
+            raise ValueError("draft_scale must be one of %s" % ", ".join(map(str, DRAFT_SCALES)))
+        self.image_dir = image_dir
+        self.intensity_file = intensity_file
+        self.color_code_file = color_code_file
+        self.store_file = store_file
+        self.manifest_file = manifest_file
+        # near-duplicate index (see Duplicates.py), None to skip it, and
+        # the arguments of its DuplicateIndex
+        self.duplicates_file = duplicates_file
+        self.duplicate_params = duplicate_params or {}
+        self.workers = workers or os.cpu_count() or 1
+        # Upper bound on images in flight at once, this is what keeps
+        # memory bounded on big corpora.
+        self.max_pending = max_pending or self.workers * 4
+        # images are encoded at 1/draft_scale of their size
+        self.draft_scale = draft_scale
+        self.entries = {}
+
+    def get_file_list(self):
+        return sorted(glob.glob(os.path.join(self.image_dir, "*.jpg")), key=numericalSort)
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_file, "r") as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if manifest.get("version") != MANIFEST_VERSION:
+            return {}
+        return manifest.get("images", {})
+
+    def save_manifest(self):
+        tmp = self.manifest_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"version": MANIFEST_VERSION, "images": self.entries}, f)
+        os.replace(tmp, self.manifest_file)
+
+    # Index the image folder. Returns a dict with how many images were
+    # encoded, reused from the manifest, and removed since the last run,
+    # and for every encoded image that looks like another one, the file
+    # names of those ("duplicates").
+    def run(self, force=False):
+        old_entries = {} if force else self.load_manifest()
+        files = self.get_file_list()
+        self.entries = {}
+        todo = []
+        reused = 0
+
+        # Bins encoded at another draft scale are not reused.
+        old_entries = {path: entry for path, entry in old_entries.items()
+                       if entry.get("draft", 1) == self.draft_scale}
+
+        # Images whose size and mtime didn't change are reused without
+        # even reading them.
+        for path in files:
+            st = os.stat(path)
+            entry = old_entries.get(path)
+            if entry is not None and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+                self.entries[path] = entry
+                reused += 1
+            else:
+                todo.append((path, st))
+
+        encoded = 0
+        new_files = []
+        if todo:
+            stats = dict(todo)
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                pending = set()
+                remaining = iter(todo)
+                while True:
+                    for path, st in remaining:
+                        entry = old_entries.get(path)
+                        known_hash = entry["sha1"] if entry is not None else None
+                        pending.add(pool.submit(encode_file, path, known_hash, self.draft_scale))
+                        if len(pending) >= self.max_pending:
+                            break
+                    if not pending:
+                        break
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        path, sha1, dims, CcBins, InBins = future.result()
+                        st = stats[path]
+                        if CcBins is None:
+                            # touched but the content is the same
+                            entry = dict(old_entries[path])
+                            reused += 1
+                        else:
+                            entry = {"dims": dims, "color": CcBins, "intensity": InBins}
+                            if self.draft_scale != 1:
+                                entry["draft"] = self.draft_scale
+                            encoded += 1
+                            new_files.append(path)
+                        entry.update(size=st.st_size, mtime_ns=st.st_mtime_ns, sha1=sha1)
+                        self.entries[path] = entry
+
+        # colorCodes.txt holds the 64 bins without the pixel count,
+        # intensity.txt holds the pixel count and the 25 bins.
+        intenCode = [self.entries[path]["intensity"] for path in files]
+        colorCode = [self.entries[path]["color"][1:] for path in files]
+        write_bins_file(self.intensity_file, intenCode)
+        write_bins_file(self.color_code_file, colorCode)
+        if files:
+            FeatureStore.write(self.store_file, files, intenCode, colorCode,
+                               [self.entries[path]["dims"] for path in files])
+        self.save_manifest()
+        duplicates = self.index_duplicates(files, intenCode, colorCode, new_files, force)
+
+        removed = len(set(old_entries) - set(files))
+        return {"images": len(files), "encoded": encoded, "reused": reused, "removed": removed,
+                "duplicates": duplicates}
+
+    # Brings the near-duplicate index up to date and saves it, and looks up
+    # the new images in it. Returns {new image: [file names that look like
+    # it]}.
+    def index_duplicates(self, files, intenCode, colorCode, new_files, force=False):
+        if self.duplicates_file is None:
+            return {}
+        index = None if force else load_index(self.duplicates_file, **self.duplicate_params)
+        if index is None:
+            index = DuplicateIndex.from_bins(files, colorCode, intenCode, **self.duplicate_params)
+        else:
+            current = set(files)
+            for path in [path for path in index.ids if path not in current]:
+                index.remove(path)
+            # the encoded images, and any the index doesn't have
+            changed = set(new_files)
+            rows = [i for i, path in enumerate(files) if path in changed or path not in index.ids]
+            index.add([files[i] for i in rows],
+                      signatures(np.asarray(colorCode)[rows], np.asarray(intenCode)[rows]))
+        index.save(self.duplicates_file)
+        duplicates = {}
+        for path in sorted(new_files, key=numericalSort):
+            i = index.ids[path]
+            matches = index.lookup(index.signatures.array[i], exclude=i)
+            if matches:
+                duplicates[path] = [filename for _, filename, _ in matches]
+        return duplicates
+
+
+# Executable section.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild the histogram files from the image folder.")
+    parser.add_argument("--images", default="images", help="folder with the .jpg images")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--force", action="store_true", help="re-encode every image")
+    parser.add_argument("--draft", type=int, default=1, choices=DRAFT_SCALES,
+                        help="decode the JPEGs at 1/DRAFT of their width and height")
+    parser.add_argument("--drift-report", type=int, metavar="N",
+                        help="only report the histogram drift of --draft on the first N images")
+    args = parser.parse_args()
+
+    indexer = Indexer(image_dir=args.images, workers=args.workers, draft_scale=args.draft)
+    if args.drift_report:
+        if args.draft == 1:
+            parser.error("--drift-report needs --draft 2, 4 or 8")
+        print(json.dumps(draft_drift(indexer.get_file_list()[:args.drift_report], args.draft), indent=2))
+        raise SystemExit
+    result = indexer.run(force=args.force)
+    print("Indexed %(images)d images (%(encoded)d encoded, %(reused)d reused, %(removed)d removed)" % result)
+    for path, matches in result["duplicates"].items():
+        print("%s looks like %s" % (path, ", ".join(matches)))
@@ -0,0 +1,136 @@
+# Metrics.py
+# Stage timers and counters for finding out where the time goes.
+#
+# Off by default. Set CBIR_METRICS=1 (or call metrics.enable()) to turn it
+# on. When it is off, metrics.timer() hands back one shared do-nothing
+# context manager and metrics.count() returns right away, so the
+# instrumented code pays about one method call per stage.
+#
+#   from Metrics import metrics
+#   with metrics.timer("rank"):
+#       ...
+#   metrics.count("distances_computed", len(matrix))
+#
+# metrics.snapshot() gives the numbers as a dict, metrics.report() as a
+# table sorted by total time, metrics.dump(path) writes a JSON snapshot.
+# CBIR_METRICS_DUMP=path writes one every CBIR_METRICS_INTERVAL seconds
+# (default 60).
+
+import json, os, threading, time
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+NULL_TIMER = NullTimer()
+
+
+class Timer:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.record(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+class Metrics:
+    # Constructor.
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        # stage -> [calls, total seconds, max seconds]
+        self.timers = {}
+        self.counters = {}
+        self.dump_thread = None
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    # Context manager timing one run of a stage.
+    def timer(self, stage):
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, stage)
+
+    def record(self, stage, seconds):
+        with self.lock:
+            timer = self.timers.get(stage)
+            if timer is None:
+                self.timers[stage] = [1, seconds, seconds]
+            else:
+                timer[0] += 1
+                timer[1] += seconds
+                if seconds > timer[2]:
+                    timer[2] = seconds
+
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def reset(self):
+        with self.lock:
+            self.timers = {}
+            self.counters = {}
+
+    def snapshot(self):
+        with self.lock:
+            timers = {stage: {"calls": calls, "total_seconds": total,
+                              "mean_ms": total / calls * 1000, "max_ms": longest * 1000}
+                      for stage, (calls, total, longest) in self.timers.items()}
+            counters = dict(self.counters)
+        return {"time": time.time(), "enabled": self.enabled, "timers": timers, "counters": counters}
+
+    # Profile report, the stages with the most total time first.
+    def report(self):
+        snapshot = self.snapshot()
+        lines = ["%-28s %8s %12s %10s %10s" % ("stage", "calls", "total s", "mean ms", "max ms")]
+        for stage, timer in sorted(snapshot["timers"].items(), key=lambda item: -item[1]["total_seconds"]):
+            lines.append("%-28s %8d %12.4f %10.3f %10.3f" % (stage, timer["calls"], timer["total_seconds"],
+                                                             timer["mean_ms"], timer["max_ms"]))
+        if snapshot["counters"]:
+            lines.append("")
+            lines.append("%-28s %8s" % ("counter", "value"))
+            for name, value in sorted(snapshot["counters"].items()):
+                lines.append("%-28s %8d" % (name, value))
+        return "\n".join(lines)
+
+    def dump(self, path):
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(tmp, path)
+
+    # Writes a snapshot to path every interval seconds, from a daemon thread.
+    def start_periodic_dump(self, path, interval=60):
+        if self.dump_thread is not None:
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.dump(path)
+
+        self.dump_thread = threading.Thread(target=run, name="metrics-dump", daemon=True)
+        self.dump_thread.start()
+
+
+metrics = Metrics(enabled=os.environ.get("CBIR_METRICS", "0") not in ("", "0"))
+if metrics.enabled and os.environ.get("CBIR_METRICS_DUMP"):
+    metrics.start_periodic_dump(os.environ["CBIR_METRICS_DUMP"],
+                                float(os.environ.get("CBIR_METRICS_INTERVAL", 60)))
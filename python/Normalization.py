@@ -0,0 +1,98 @@
+# Normalization.py
+# Streaming column statistics for the gaussian normalization of the
+# feature matrix.
+#
+# The mean and variance of every feature column are kept as running
+# statistics (Welford's method), so an image can be added to or removed
+# from the corpus in O(features) time instead of recomputing every column
+# over every image.
+
+import numpy as np
+
+FEATURES = 89
+
+# When the stored normalized feature matrix is brought up to date after
+# images are added or removed:
+# "immediate" - right away, on every change
+# "lazy"      - the next time the normalized matrix is asked for
+# "batch"     - after batch_size changes, once the oldest pending change
+#               is batch_interval seconds old, or when refresh is called.
+#               In between, new images are normalized with the current
+#               statistics and the older rows keep the statistics of the
+#               last refresh.
+POLICIES = ("immediate", "lazy", "batch")
+
+
+# Combines the intensity bins (without the pixel count) and the color code
+# bins of every image and divides them by the image size (the pixel count).
+def combine_bins(intenCode, colorCode):
+    intenCode = np.asarray(intenCode, dtype=np.float64).reshape(-1, 26)
+    colorCode = np.asarray(colorCode, dtype=np.float64).reshape(-1, 64)
+    return np.hstack((intenCode[:, 1:], colorCode)) / intenCode[:, :1]
+
+
+class RunningStats:
+    # Constructor. Empty statistics over the given number of columns.
+    def __init__(self, features=FEATURES):
+        self.count = 0
+        self.mean = np.zeros(features)
+        # sum of squared differences from the mean
+        self.m2 = np.zeros(features)
+
+    # Statistics of the rows of a matrix.
+    @staticmethod
+    def from_matrix(matrix):
+        matrix = np.asarray(matrix, dtype=np.float64)
+        stats = RunningStats(matrix.shape[1])
+        stats.count = len(matrix)
+        if stats.count:
+            stats.mean = matrix.mean(axis=0)
+            stats.m2 = ((matrix - stats.mean) ** 2).sum(axis=0)
+        return stats
+
+    # Statistics from stored column averages and (sample) standard
+    # deviations, like the ones in the feature store.
+    @staticmethod
+    def from_moments(count, column_avgs, column_stds):
+        stats = RunningStats(len(column_avgs))
+        stats.count = count
+        stats.mean = np.array(column_avgs, dtype=np.float64)
+        stats.m2 = np.asarray(column_stds, dtype=np.float64) ** 2 * max(count - 1, 0)
+        return stats
+
+    def add(self, row):
+        row = np.asarray(row, dtype=np.float64)
+        self.count += 1
+        delta = row - self.mean
+        self.mean = self.mean + delta / self.count
+        self.m2 = self.m2 + delta * (row - self.mean)
+
+    def remove(self, row):
+        row = np.asarray(row, dtype=np.float64)
+        if self.count <= 1:
+            self.__init__(len(self.mean))
+            return
+        old_mean = self.mean
+        self.count -= 1
+        self.mean = (old_mean * (self.count + 1) - row) / self.count
+        # rounding can take a column a hair below zero
+        self.m2 = np.maximum(self.m2 - (row - old_mean) * (row - self.mean), 0)
+
+    # Sample standard deviation of every column (0 with fewer than 2 rows).
+    def std(self):
+        if self.count < 2:
+            return np.zeros(len(self.mean))
+        return np.sqrt(self.m2 / (self.count - 1))
+
+    # Gaussian normalization of rows with these statistics.
+    def normalize(self, rows):
+        return normalize(rows, self.mean, self.std())
+
+
+# Gaussian normalization of rows: (value - column average) / column std,
+# and 0 for the columns whose std is 0.
+def normalize(rows, column_avgs, column_stds):
+    rows = np.asarray(rows, dtype=np.float64)
+    column_stds = np.asarray(column_stds, dtype=np.float64)
+    safe_stds = np.where(column_stds != 0, column_stds, 1)
+    return np.where(column_stds != 0, (rows - column_avgs) / safe_stds, 0)
@@ -1,11 +1,97 @@
 # PixInfo.py
 # Program to start evaluating an image in python
-from PIL import Image, ImageTk
-import glob, os, re
+from PIL import Image
+import glob, os, re, threading, time
+from collections.abc import Sequence
 import numpy as np
-
-intensityMatrix = []
-colorCodeMatrix = []
+from FeatureStore import FeatureStore, RowBuffer
+from Normalization import RunningStats, combine_bins, POLICIES
+from Feedback import feedback_weights, initial_weights
+from Snapshot import Snapshot, corpus_fingerprint
+from Metrics import metrics
+
+numbers = re.compile(r'(\d+)')
+
+# Joint bins of the single pass encode: intensity bin * 64 + color code.
+JOINT_BINS = 26 * 64
+# uint16 table of the joint bin of every 24-bit color, made the first
+# time an image is encoded (32MB, about half a second). The server and
+# the watcher make it when they start.
+joint_table = None
+
+# Draft scales a JPEG can be decoded at, see PixInfo.encode_file.
+DRAFT_SCALES = (1, 2, 4, 8)
+
+
+# helper function, sorts file names by the numbers in them
+# so images/2.jpg comes before images/10.jpg
+def numericalSort(value):
+    parts = numbers.split(value)
+    parts[1::2] = map(int, parts[1::2])
+    return parts
+
+
+# The joint bin of every color r | g << 8 | b << 16. The intensity bin is
+# computed with the same float64 formula as intensity_method (on the
+# boundaries of the bins it is not the same as exact integer arithmetic),
+# one red value at a time to keep the temporaries small.
+def get_joint_table():
+    global joint_table
+    if joint_table is None:
+        values = np.arange(256)
+        r = 0.299 * values.astype(np.float64)
+        g = 0.587 * values.astype(np.float64)
+        b = 0.114 * values.astype(np.float64)
+        top_bits = values >> 6
+        # color codes of every (green, red), without the blue bits
+        rg_codes = (top_bits[None, :] << 4) | (top_bits[:, None] << 2)
+        table = np.empty((256, 256, 256), dtype=np.uint16)
+        for blue in range(256):
+            # table[blue][green][red]
+            intensity = (r[None, :] + g[:, None]) + b[blue]
+            bins = np.minimum((intensity + 10) // 10, 25).astype(np.uint16)
+            table[blue] = bins * 64 + (rg_codes | top_bits[blue])
+        joint_table = table.ravel()
+    return joint_table
+
+
+# The 24-bit colors of a (height, width, 3) uint8 array, as r | g << 8 | b << 16.
+def pack_pixels(pixels):
+    padded = np.zeros(pixels.shape[:2] + (4,), dtype=np.uint8)
+    padded[..., :3] = pixels
+    return padded.view("<u4").reshape(-1)
+
+
+# Counts scaled to add up to total, rounded so that they do (largest
+# remainders first). counts can also be a matrix with a total per row,
+# every row is scaled to its own total. All zero counts stay zero.
+def scale_counts(counts, total):
+    counts = np.asarray(counts, dtype=np.float64)
+    sums = counts.sum(axis=-1)
+    total = np.asarray(total, dtype=np.float64)
+    exact = counts * (total / np.where(sums == 0, 1, sums))[..., None]
+    scaled = np.floor(exact).astype(np.int64)
+    short = np.where(sums == 0, 0, total - scaled.sum(axis=-1))
+    order = np.argsort(scaled - exact, axis=-1, kind="stable")
+    ranked = np.take_along_axis(scaled, order, axis=-1) + (np.arange(counts.shape[-1]) < short[..., None])
+    np.put_along_axis(scaled, order, ranked, axis=-1)
+    return scaled
+
+
+# List of the images of the corpus. An image is opened from its file
+# when it is asked for and is not kept, so the full-size images are
+# never all held in memory.
+class LazyImageList(Sequence):
+    def __init__(self, fileList):
+        self.fileList = fileList
+
+    def __len__(self):
+        return len(self.fileList)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return Image.open(self.fileList[i])
 
 
 # Pixel Info class.
@@ -13,71 +99,146 @@ class PixInfo:
     imageCount = 1
 
     # Constructor.
-    def __init__(self, master):
+    # master is only kept for the GUI, PixInfo itself never touches Tk.
+    # normalization_policy says when the normalized feature matrix is
+    # refreshed after images are added or removed (see Normalization.py).
+    # With the "batch" policy that is after batch_size changes, or once
+    # the oldest pending change is batch_interval seconds old (None for no
+    # time limit).
+    # The loaded state is saved to a snapshot in snapshot_dir for a fast
+    # next start (see Snapshot.py), snapshot_dir=None turns that off.
+    def __init__(self, master=None, thumbnail_dir=".thumbnails",
+                 normalization_policy="lazy", batch_size=1000, snapshot_dir=".snapshot",
+                 batch_interval=None):
+        if normalization_policy not in POLICIES:
+            raise ValueError("unknown normalization policy %r, expected one of %s"
+                             % (normalization_policy, ", ".join(POLICIES)))
         self.master = master
-        self.imageList = []
-        self.photoList = []
+        self.photoList = None
         self.imageSizes = []
         self.imgTrueSizes = []
         self.xmax = 0
         self.ymax = 0
         self.colorCode = []
         self.intenCode = []
-        self.fileList = []
-        self.binary_cache = dict()
-        self.color_cache = dict()
+        self.dims = None
         self.feature_matrix = []
-        self.weights = [1/89] * 89
+        self.weights = initial_weights()
         self.column_avgs = []
         self.column_stds = []
-
-        # helper function
-        numbers = re.compile(r'(\d+)')
-        def numericalSort(value):
-            parts = numbers.split(value)
-            parts[1::2] = map(int, parts[1::2])
-            return parts
-
-        # Add each image (for evaluation) into a list,
-        # and a Photo from the image (for the GUI) in a list.
-        for infile in sorted(glob.glob('images/*.jpg'), key=numericalSort):
-            file, ext = os.path.splitext(infile)
-            self.fileList.append(file + ".jpg")
-            im = Image.open(infile)
-
-            # Resize the image for thumbnails.
-            imSize = im.size
-            x = int(imSize[0] / 4)
-            y = int(imSize[1] / 4)
-            self.imageSizes.append(x * y)
-            imResize = im.resize((x, y), Image.ANTIALIAS)
-            photo = ImageTk.PhotoImage(imResize)
-
-            # Find the max height and width of the set of pics.
-            if x > self.xmax:
-                self.xmax = x
-            if y > self.ymax:
-                self.ymax = y
-
-            # Add the images to the lists.
-            self.imageList.append(im)
-            self.photoList.append(photo)
-
-        # Create a list of pixel data for each image and add it
-        # to a list.
-        for image in self.imageList[:]:
-            width, height = image.size
-
-        # Get histogram bins for each method.
-        self.readIntensityFile()
-        self.readColorCodeFile()
-        self.turnToInt()
-        self.get_image_true_sizes()
-        self.calculate_normalized_feat_matrix()
+        self.stats = None
+        self.normalization_policy = normalization_policy
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.normalization_stale = False
+        self.pending_changes = 0
+        # time.monotonic() of the oldest change not normalized yet
+        self.stale_since = None
+        # goes up every time the corpus or its normalization changes
+        self.corpus_version = 0
+        # held by whoever changes the corpus (see Watcher.py) and by the
+        # DistanceEngine while it copies it
+        self.lock = threading.RLock()
+        self.buffers = None
+        self.thumbnail_dir = thumbnail_dir
+        self.thumbnails = None
+        self.snapshot = Snapshot(snapshot_dir) if snapshot_dir is not None else None
+
+        with metrics.timer("load"):
+            # The images (for evaluation) are only opened when they are used.
+            with metrics.timer("load.glob"):
+                self.fileList = sorted(glob.glob('images/*.jpg'), key=numericalSort)
+                self.imageList = LazyImageList(self.fileList)
+
+            # Get histogram bins for each method, from the snapshot of the
+            # last start if the corpus is the same, from the binary feature
+            # store if the indexer wrote one, otherwise from the text files.
+            with metrics.timer("load.snapshot"):
+                from_snapshot = self.readSnapshot()
+            from_store = from_snapshot
+            if not from_snapshot:
+                with metrics.timer("load.feature_store"):
+                    from_store = self.readFeatureStore()
+            if not from_store:
+                with metrics.timer("load.parse_text"):
+                    self.readIntensityFile()
+                    self.readColorCodeFile()
+                    self.turnToInt()
+                    self.check_row_counts()
+                    self.get_image_true_sizes()
+                self.calculate_normalized_feat_matrix()
+            with metrics.timer("load.image_sizes"):
+                self.get_thumbnail_sizes()
+            # features.bin is as fast to open as a snapshot, only the
+            # state built from the text files is worth saving
+            if not from_store:
+                with metrics.timer("load.save_snapshot"):
+                    self.writeSnapshot()
+        metrics.count("images_loaded", len(self.fileList))
+
+    # Thumbnail size of every image, and the max height and width of the set
+    # of thumbnails. The image sizes come from the feature store when there
+    # is one, otherwise only the header of each file is read.
+    def get_thumbnail_sizes(self):
+        if self.dims is None:
+            self.dims = []
+            for infile in self.fileList:
+                with Image.open(infile) as im:
+                    self.dims.append(im.size)
+        dims = np.asarray(self.dims, dtype=np.int64).reshape(-1, 2)
+        self.imageSizes = (dims[:, 0] // 4) * (dims[:, 1] // 4)
+        self.get_max_thumbnail_size()
+
+    # The max width and height of the set of thumbnails.
+    def get_max_thumbnail_size(self):
+        dims = np.asarray(self.dims, dtype=np.int64).reshape(-1, 2)
+        self.xmax = int(dims[:, 0].max()) // 4 if len(dims) else 0
+        self.ymax = int(dims[:, 1].max()) // 4 if len(dims) else 0
+
+    # Open the binary feature store (see FeatureStore.py). The bins and the
+    # normalized feature matrix are memory mapped, not read.
+    # Returns False if there is no usable store for the current images.
+    def readFeatureStore(self, filename="features.bin"):
+        if not os.path.exists(filename):
+            return False
+        try:
+            store = FeatureStore(filename)
+        except (IOError, ValueError) as e:
+            print("could not open %s: %s" % (filename, e))
+            return False
+        if len(store) != len(self.fileList) or list(store.fileList) != self.fileList:
+            print("file %s is out of date, reading the text files instead" % filename)
+            return False
+
+        self.intenCode = store.intenCode
+        self.colorCode = store.colorCode
+        self.dims = store.dims
+        self.imgTrueSizes = store.intenCode[:, 0]
+        self.column_avgs = store.column_avgs
+        self.column_stds = store.column_stds
+        self.stats = RunningStats.from_moments(len(store), store.column_avgs, store.column_stds)
+        self.feature_matrix = store.feature_matrix
+        return True
+
+    # Open the snapshot for the current corpus, if there is one.
+    def readSnapshot(self):
+        if self.snapshot is None:
+            return False
+        self.fingerprint = corpus_fingerprint(self.fileList)
+        path = self.snapshot.find(self.fingerprint)
+        return path is not None and self.readFeatureStore(path)
+
+    def writeSnapshot(self):
+        if self.snapshot is None or not self.fileList:
+            return
+        try:
+            self.snapshot.save(self.fingerprint, self.fileList, self.intenCode, self.colorCode, self.dims,
+                               self.column_avgs, self.column_stds, self.feature_matrix)
+        except (IOError, OSError, ValueError) as e:
+            print("could not save the snapshot: %s" % e)
 
     def get_image_true_sizes(self):
-        for i in range(len(self.intenCode)):
-            self.imgTrueSizes.append(self.intenCode[i][0])
+        self.imgTrueSizes = self.intenCode[:, 0]
 
     def readIntensityFile(self):
         # open the file intensity.txt
@@ -85,14 +246,15 @@ class PixInfo:
         try:
             # empty string to store a line in the file thats going to be read
             line = ""
+            intensityMatrix = []
             intensityFile = open("intensity.txt", "r")
-            for i in range(0, 100):
-                line = intensityFile.readline()
+            # one row per image, as many rows as the indexer wrote
+            for line in intensityFile:
+                line = line.strip()
+                if line == "":
+                    continue
                 l = re.split(',', line)
-                # loops through length
-
                 intensityMatrix.append(l)
-                intensityMatrix[i][len(l) - 1] = float(l[len(l) - 1][0:len(l) - 1])
 
             intensityFile.close()
             self.intenCode = intensityMatrix
@@ -105,120 +267,177 @@ class PixInfo:
         try:
             # empty string to store a line in the file thats going to be read
             line = ""
+            colorCodeMatrix = []
             colorCodeFile = open("colorCodes.txt", "r")
-            for i in range(0, 100):
-                line = colorCodeFile.readline()
+            for line in colorCodeFile:
+                line = line.strip()
+                if line == "":
+                    continue
                 l = re.split(',', line)
-
                 colorCodeMatrix.append(l)
-
-                colorCodeMatrix[i][len(l)-1] = float(l[len(l)-1][0:len(l) - 1])
             # close file when done using
             colorCodeFile.close()
             self.colorCode = colorCodeMatrix
         except IOError as e:
             print("file intensity.txt not found!")
+    # The bins are kept as uint32 arrays, indexed [image][bin] like the
+    # lists they are read into.
     def turnToInt(self):
-        for i in range(len(self.colorCode)):
-            self.colorCode[i] = [int(float(j)) for j in self.colorCode[i]]
-        for i in range(len(self.intenCode)):
-            self.intenCode[i] = [int(float(j)) for j in self.intenCode[i]]
+        self.colorCode = np.asarray(self.colorCode, dtype=np.float64).reshape(-1, 64).astype(np.uint32)
+        self.intenCode = np.asarray(self.intenCode, dtype=np.float64).reshape(-1, 26).astype(np.uint32)
+
+    # The text files must have one row per image of the images folder, in
+    # the same order, or the rows would be matched with the wrong images.
+    def check_row_counts(self):
+        count = len(self.fileList)
+        for name, rows in (("intensity.txt", len(self.intenCode)), ("colorCodes.txt", len(self.colorCode))):
+            if rows != count:
+                raise ValueError("%s has %d rows but images/ has %d images, "
+                                 "run python ./python/Indexer.py to index them again" % (name, rows, count))
 
     # Bin function returns an array of bins for the image(given as an argument),
     # both Intensity and Color-Code methods.
-    def encode(self, image, width, height):
-
-        # 2D array initilazation for bins, initialized
-        # to zero.
-        CcBins = [
-                     0] * 65  # 64 bins. index 0 -> total number of pixels in picture, index 1 -> bin 1, index 2 -> bin 2 ...
-        InBins = [0] * 26  # 25 bins. Again, first index stores total pixels.
-
-        InBins = self.intensity_method(image, width, height, InBins)
-        CcBins = self.color_code_method(image, width, height, CcBins)
+    # The pixels are read into a uint8 array once, and both histograms
+    # come out of one pass over it (see encode_pixels).
+    @staticmethod
+    def encode(image, width, height):
+        with metrics.timer("encode"):
+            return PixInfo.encode_pixels(PixInfo.read_pixels(image, width, height), width, height)
+
+    # encode for pixels already read with read_pixels. Every pixel is
+    # looked up once in the joint table, which gives its intensity bin and
+    # its color code together; the two histograms are the row and column
+    # sums of the joint histogram. The bins are the same as the ones of
+    # intensity_method and color_code_method.
+    @staticmethod
+    def encode_pixels(pixels, width, height):
+        metrics.count("images_encoded")
+        metrics.count("pixels_processed", width * height)
+
+        joint = np.bincount(get_joint_table()[pack_pixels(pixels)], minlength=JOINT_BINS).reshape(26, 64)
+
+        # index 0 of both -> total number of pixels in picture
+        CcBins = [width * height] + [int(c) for c in joint.sum(axis=0)]  # 64 bins
+        InBins = [width * height] + [int(c) for c in joint.sum(axis=1)[1:]]  # 25 bins
 
         return CcBins, InBins
 
+    # Opens an image file and encodes it. Returns ((width, height), CcBins,
+    # InBins). With a draft_scale of 2, 4 or 8 a JPEG is decoded at that
+    # fraction of its width and height (PIL's draft mode, the DCT does the
+    # scaling), which is several times faster; the counts are then scaled
+    # up to the full pixel count, so the bins stay comparable with the
+    # ones of full-size images. Only JPEGs can be decoded in draft mode,
+    # other images are always decoded at full size.
+    @staticmethod
+    def encode_file(path, draft_scale=1):
+        if draft_scale not in DRAFT_SCALES:
+            raise ValueError("draft_scale must be one of %s" % ", ".join(map(str, DRAFT_SCALES)))
+        with Image.open(path) as im:
+            width, height = im.size
+            if draft_scale > 1:
+                im.draft("RGB", (width // draft_scale, height // draft_scale))
+            with metrics.timer("encode"):
+                pixels = PixInfo.read_pixels(im, *im.size)
+                CcBins, InBins = PixInfo.encode_pixels(pixels, *im.size)
+        total = width * height
+        if CcBins[0] != total:
+            CcBins = [total] + scale_counts(CcBins[1:], total).tolist()
+            InBins = [total] + scale_counts(InBins[1:], total).tolist()
+        return (width, height), CcBins, InBins
+
+    # Batch version of encode. Takes a list of images (PIL images or
+    # file names) and returns a list of (CcBins, InBins) tuples in the
+    # same order.
+    @staticmethod
+    def encode_batch(images):
+        results = []
+        for image in images:
+            if isinstance(image, str):
+                with Image.open(image) as im:
+                    results.append(PixInfo.encode(im, *im.size))
+            else:
+                results.append(PixInfo.encode(image, *image.size))
+        return results
+
+    # Reads the top-left width x height region of an image into a
+    # (height, width, 3) uint8 array. Arrays that were already read are
+    # passed through untouched.
+    @staticmethod
+    def read_pixels(im, width, height):
+        if isinstance(im, np.ndarray):
+            return im[:height, :width]
+        if im.mode != "RGB":
+            im = im.convert("RGB")
+        return np.asarray(im, dtype=np.uint8)[:height, :width]
+
     # Intensity method
     # Formula: I = 0.299R + 0.587G + 0.114B
     # 24-bit of RGB (8 bits for each color channel) color
     # intensities are transformed into a single 8-bit value.
     # There are 24 histogram bins.
-    def intensity_method(self, im, width, height, InBins):
-        total_pixels = width * height
-        InBins[0] = total_pixels
-
-        for y in range(height):  # reads pixels left to right, top down (by each row).
-            for x in range(width):  # This example code reads the RGB (red, green, blue) values
-
-                r, g, b = im.getpixel((x, y))  # in every pixel of a 'x' pixel wide 'y' pixel tall image.
-                intensity = (0.299 * r) + (0.587 * g) + (0.114 * b)
-                bin = int((intensity + 10) // 10)  # Division rounds down to bin number.. in this case bins will range 0-24 (25 bins).
-
-                if bin == 26:  # last bin is 240 to 255, so bin of 24 and 25 will
-                    bin = 25  # correspond to bin 24, BUT +1 since first index stores total pixels.
-                InBins[bin] += 1  # allocate pixel to corresponding bin
-
+    @staticmethod
+    def intensity_method(im, width, height, InBins):
+        pixels = PixInfo.read_pixels(im, width, height)
+        InBins[0] = width * height
+
+        r = pixels[..., 0].astype(np.float64)
+        g = pixels[..., 1].astype(np.float64)
+        b = pixels[..., 2].astype(np.float64)
+        intensity = (0.299 * r) + (0.587 * g) + (0.114 * b)
+        # Division rounds down to bin number.. in this case bins will range 0-24 (25 bins).
+        # last bin is 240 to 255, so bin of 24 and 25 will correspond to bin 24,
+        # BUT +1 since first index stores total pixels.
+        bins = np.minimum((intensity + 10) // 10, 25).astype(np.intp)
+        counts = np.bincount(bins.ravel(), minlength=26)
+
+        for i in range(1, 26):
+            InBins[i] += int(counts[i])
         return InBins
 
     # Color-Code Method
     # 24-bit of RGB color intensities transformed into 6-bit color
     # code from the first 2 bits of each of the three colors.
     # There are 64 histogram bins.
-    def color_code_method(self, im, width, height, CcBins):
-        total_pixels = width * height
-        CcBins[0] = total_pixels
-
-        for y in range(height):
-            for x in range(width):
-
-                r, g, b = im.getpixel((x, y))
-                eight_r = self.convert_to_eight_bit(str(self.decimal_to_binary(r)))
-                eight_g = self.convert_to_eight_bit(str(self.decimal_to_binary(g)))
-                eight_b = self.convert_to_eight_bit(str(self.decimal_to_binary(b)))
-                r = self.first_two_nums(eight_r)  # get binary representation, then
-                g = self.first_two_nums(eight_g)  # get the first two significant numbers
-                b = self.first_two_nums(eight_b)
-
-                color_code = r + g + b
-                if color_code in self.color_cache:
-                    bin = self.color_cache[color_code]
-                else:
-                    bin = self.binary_to_decimal(color_code)
-                    self.color_cache[color_code] = bin
-                CcBins[bin + 1] += 1  # allocate pixel to corresponding bin, +1 since first index stores total pixels
-
+    @staticmethod
+    def color_code_method(im, width, height, CcBins):
+        pixels = PixInfo.read_pixels(im, width, height)
+        CcBins[0] = width * height
+
+        # the first two significant bits of each 8-bit channel, packed as RRGGBB
+        top_bits = pixels >> 6
+        color_code = (top_bits[..., 0].astype(np.intp) << 4) | (top_bits[..., 1] << 2) | top_bits[..., 2]
+        counts = np.bincount(color_code.ravel(), minlength=64)
+
+        for i in range(64):
+            CcBins[i + 1] += int(counts[i])  # +1 since first index stores total pixels
         return CcBins
 
-    # Convert binary to 8-bit form
-    def convert_to_eight_bit(self, num):
-        zeroes = 8 - len(num)
-        return ("0" * zeroes) + num
-
-    # Function to convert decimal number to binary using recursion
-    def decimal_to_binary(self, num):
-        return bin(num).replace("0b", "")
-
-    # Turns a binary string to a decimal int
-    def binary_to_decimal(self, binary):
-        if binary in self.binary_cache:
-            return self.binary_cache[binary]
-        decimal = int(binary, 2)
-        self.binary_cache[binary] = decimal
-        return decimal
-
-    # Gets the first two significant digits of the binary.
-    def first_two_nums(self, num):
-        first_two = num[:2]
-        return first_two
-
     # Accessor functions:
     def get_imageList(self):
         return self.imageList
 
+    # Photo of the thumbnail of image i (for the GUI), from the on-disk
+    # thumbnail cache. Only the GUI needs Tk, so ImageTk is imported here.
+    def get_photo(self, i):
+        from PIL import ImageTk
+        return ImageTk.PhotoImage(self.get_thumbnail(i))
+
+    # Photos of all the thumbnails. They are made the first time they are
+    # asked for, the viewer uses get_photo for the images it shows instead.
     def get_photoList(self):
+        if self.photoList is None:
+            self.photoList = [self.get_photo(i) for i in range(len(self.fileList))]
         return self.photoList
 
+    # The image resized to a quarter of its width and height, from the
+    # thumbnail cache (which is only set up once a thumbnail is needed).
+    def get_thumbnail(self, i):
+        if self.thumbnails is None:
+            from Thumbnails import ThumbnailCache
+            self.thumbnails = ThumbnailCache(self.thumbnail_dir)
+        return self.thumbnails.get(self.fileList[i])
+
     def get_xmax(self):
         return self.xmax
 
@@ -251,107 +470,148 @@ class PixInfo:
     # User picked images 3 and 10 as relevant to the query image. Returns [1, 3, 10]
     # RF method creates normalized feature matrix
     def calculate_normalized_feat_matrix(self):
-        # Get all the bins since we will need to combine them
-        Cc_bins = self.get_colorCode()
-        Inten_bins = self.get_intenCode()
-        all_features = []  # this should hold feature matrixes of all images
-
-        for image_number in range(100):
-            # Get the relevant img's bins
-            img_cc_bins = Cc_bins[image_number]
-            img_inten_bins = Inten_bins[image_number]
-            total_bins = img_inten_bins[1:] + img_cc_bins
-            feature_matrix = []
-
-            # Take each number in each bin and divide by the total pixels (image size)
-            for num in total_bins:
-                feature_matrix.append(num / self.imgTrueSizes[image_number])
-
-            all_features.append(feature_matrix)
-        # Start feature normalization
-        column_avgs = []  # average of each column (index 0 number is the average of first column)
-        # Calculate each column's average
-        for i in range(89):  # go through each bin in column order
-            sum = 0
-            for j in range(100):
-                sum += all_features[j][i]
-            column_average = sum / 100
-            column_avgs.append(column_average)
-        self.column_avgs = column_avgs
-
-        # Calculate each column's standard deviation
-        column_stds = []  # standard deviation for each column (index 0 number is std of first column)
-        for i in range(89):
-            std_sum = 0
-            for j in range(100):
-                std_for_column = ((all_features[j][i] - column_avgs[i]) ** 2) / (100 - 1)
-                std_sum += std_for_column
-            column_std = std_sum ** 0.5  # column_std = math.sqrt(std_sum)
-            column_stds.append(column_std)
-            # std = square root of ( ( (each column's cell number - column's average)^2 / total number of cells in column ) + do for the rest.. its summation )
-        self.column_stds = column_stds
-
-        # gaussian normalization
-        for i in range(89):
-            for j in range(100):
-                if column_stds[i] != 0:
-                    all_features[j][i] = (all_features[j][i] - column_avgs[i]) / column_stds[i]
-                else:
-                    all_features[j][i] = 0
+        with metrics.timer("normalize"):
+            # Combine the bins and divide each by the total pixels (image size)
+            all_features = combine_bins(self.get_intenCode(), self.get_colorCode())
+
+            # Start feature normalization. The column averages and standard
+            # deviations are kept as running statistics, so images can be added
+            # and removed later without going over every image again.
+            self.stats = RunningStats.from_matrix(all_features)
+            self.column_avgs = self.stats.mean
+            self.column_stds = self.stats.std()
+
+            # gaussian normalization
             # new value of the cell = (each cell of the column - average of column) / standard deviation of column
-        # now we have normalized feature matrix!
-        self.feature_matrix = all_features
-
+            # The normalized features are kept as float32, like in the feature store.
+            self.feature_matrix = self.stats.normalize(all_features).astype(np.float32)
+            self.normalization_stale = False
+            self.pending_changes = 0
+            self.stale_since = None
+            self.corpus_version += 1
+
+    # The normalized feature matrix. With the "lazy" policy it is refreshed
+    # here if images were added or removed since the last refresh.
     def get_normalized_feature(self):
+        if self.normalization_stale and self.normalization_policy == "lazy":
+            self.refresh_normalization()
         return self.feature_matrix
 
-    def update_weights(self, relevant_imgs):
-        # get images selected as relevant into columns along with query image
-        relevant_matrix = []
-        for relevant_img in relevant_imgs:
-            relevant_matrix.append(self.feature_matrix[relevant_img])
-            
-        column_avgs = []  # average of each column
-        # Calculate each column's average
-        for i in range(89):  # go through each bin in column order
-            sum = 0
-            for j in range(len(relevant_matrix)):
-                sum += relevant_matrix[j][i]
-            column_average = sum / 100
-            column_avgs.append(column_average)
-            
-        # Calculate each column's standard deviation
-        column_stds = []  # standard deviation for each column
-        for i in range(89):
-            std_sum = 0
-            for j in range(len(relevant_matrix)):
-                std_for_column = ((relevant_matrix[j][i] - column_avgs[i]) ** 2) / (100 - 1)
-                std_sum += std_for_column
-            column_std = std_sum ** 0.5  # column_std = math.sqrt(std_sum)
-            column_stds.append(column_std)
-            # std = square root of ( ( (each column's cell number - column's average)^2 / total number of cells in column ) + do for the rest.. its summation )
-        
-        updated_weights = []
-                        
-        sum_of_cols = 0
-        # updated weight for each column  = 1/std of column
-        for i in range(89):
-            if column_stds[i] == 0:
-                if column_avgs[i] == 0:
-                    weight = 0
-                else:
-                    column_stds[i] == (1/2) * (min(column_stds))
-                    weight = 1/column_stds[i]
-            else:
-                weight = 1/column_stds[i]
-            sum_of_cols += weight
-            updated_weights.append(weight)
-            
-        self.weights.clear()
-        # normalized weight of column = updated weight of column / sum of all updated columns weights
-        for i in range(89):
-            self.weights.append(updated_weights[i]/sum_of_cols)
-            
+    # Renormalizes every row of the feature matrix with the current column
+    # statistics.
+    def refresh_normalization(self):
+        with metrics.timer("normalize.refresh"):
+            self.make_growable()
+            all_features = combine_bins(self.intenCode, self.colorCode)
+            self.buffers["feature_matrix"].array[:] = self.stats.normalize(all_features)
+            self.column_avgs = self.stats.mean
+            self.column_stds = self.stats.std()
+            self.normalization_stale = False
+            self.pending_changes = 0
+            self.stale_since = None
+            self.corpus_version += 1
+
+    # Adds an image to the corpus. CcBins and InBins are what encode returns
+    # for it, dims its (width, height). The column statistics are updated in
+    # O(features) and the image is normalized with them; the other rows are
+    # refreshed according to the normalization policy. Its thumbnail size
+    # and the max thumbnail width and height are updated in O(1).
+    def add_image(self, filename, CcBins, InBins, dims=None):
+        if dims is None:
+            with Image.open(filename) as im:
+                dims = im.size
+        self.make_growable()
+        features = combine_bins(InBins, CcBins[1:])[0]
+        self.stats.add(features)
+        x, y = int(dims[0]) // 4, int(dims[1]) // 4
+
+        self.fileList.append(filename)
+        self.buffers["intenCode"].append(InBins)
+        self.buffers["colorCode"].append(CcBins[1:])
+        self.buffers["dims"].append(dims)
+        self.buffers["feature_matrix"].append(self.stats.normalize(features))
+        self.buffers["imageSizes"].append(x * y)
+        self.xmax = max(self.xmax, x)
+        self.ymax = max(self.ymax, y)
+        self.update_arrays()
+        self.corpus_changed()
+        return len(self.fileList) - 1
+
+    # Removes image i from the corpus, the images after it move up one
+    # (one copy of the rows after it in every buffer). The max thumbnail
+    # width and height are only recomputed when the image had one of them.
+    def remove_image(self, i):
+        self.make_growable()
+        self.stats.remove(combine_bins(self.intenCode[i], self.colorCode[i])[0])
+        x, y = int(self.dims[i][0]) // 4, int(self.dims[i][1]) // 4
+
+        del self.fileList[i]
+        for buffer in self.buffers.values():
+            buffer.delete(i)
+        self.update_arrays()
+        if x == self.xmax or y == self.ymax:
+            self.get_max_thumbnail_size()
+        self.corpus_changed()
+
+    def corpus_changed(self):
+        self.corpus_version += 1
+        self.normalization_stale = True
+        self.pending_changes += 1
+        if self.stale_since is None:
+            self.stale_since = time.monotonic()
+        if self.normalization_policy == "immediate":
+            self.refresh_normalization()
+        else:
+            self.refresh_if_due()
+
+    # With the "batch" policy, refreshes the normalization if batch_size
+    # changes are pending or the oldest of them is batch_interval seconds
+    # old. Returns whether it did. Called on every change, and by whoever
+    # wants the interval kept without new changes (see Watcher.py).
+    def refresh_if_due(self):
+        if self.normalization_policy != "batch" or not self.normalization_stale:
+            return False
+        if self.pending_changes >= self.batch_size or (
+                self.batch_interval is not None and time.monotonic() - self.stale_since >= self.batch_interval):
+            self.refresh_normalization()
+            return True
+        return False
+
+    # Moves the bins, dims and feature matrix into buffers that rows can be
+    # added to (the feature store is read-only).
+    def make_growable(self):
+        if self.buffers is not None:
+            return
+        self.fileList = list(self.fileList)
+        self.imageList.fileList = self.fileList
+        self.buffers = {
+            "intenCode": RowBuffer(self.intenCode, np.uint32, 26),
+            "colorCode": RowBuffer(self.colorCode, np.uint32, 64),
+            "dims": RowBuffer(self.dims, np.uint32, 2),
+            "feature_matrix": RowBuffer(self.feature_matrix, np.float32, 89),
+            "imageSizes": RowBuffer(self.imageSizes, np.int64, 1),
+        }
+        self.update_arrays()
+
+    def update_arrays(self):
+        for name, buffer in self.buffers.items():
+            setattr(self, name, buffer.array)
+        self.imageSizes = self.imageSizes[:, 0]
+        self.imgTrueSizes = self.intenCode[:, 0]
+
+    # Back to the initial retrieval, every feature has the same weight.
+    def reset_weights(self):
+        self.weights = initial_weights()
+
+    # Relevance feedback for the whole PixInfo (see Feedback.py). Every user
+    # should rather have a FeedbackSession with its own weights.
+    # feature_matrix is the normalized feature matrix to read the rows from,
+    # this PixInfo's by default.
+    def update_weights(self, relevant_imgs, feature_matrix=None):
+        if feature_matrix is None:
+            feature_matrix = self.get_normalized_feature()
+        self.weights = feedback_weights(feature_matrix, relevant_imgs)
+
 # Intial retrieval (using same weight for all features)
 # initial weight is 1/N.. N = 89?
 # e.g. query image 1
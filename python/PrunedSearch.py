@@ -0,0 +1,179 @@
+# PrunedSearch.py
+# Exact top k search that skips the images that can't make it.
+#
+# The rows of every matrix are grouped into pages of PAGE_ROWS images,
+# and every page gets the min and max of each feature over its rows (made
+# once per index state and kept with it). For a query, the weighted L1
+# distance to the box between the min and the max is a lower bound of the
+# distance to any image of the page. Pages are visited from the lowest
+# bound up, a batch at a time:
+# - a page whose bound is above the current k-th best distance is
+#   skipped, and once the bounds of the next batch are all above it the
+#   search stops
+# - for the other pages, a partial distance over the features with the
+#   biggest weights (the current weights, after relevance feedback) is
+#   computed first; a page where every image is already past the k-th
+#   best distance with those features alone is dropped (as long as that
+#   drops enough pages to pay for itself)
+# - the pages left get their full distances, with the same arithmetic as
+#   DistanceEngine.weighted_distances, and are merged into the top k.
+#
+# How much is skipped depends on how alike the images of a page are, i.e.
+# on the order of the corpus. When the bounds leave most of it to compute,
+# the search falls back to the full scan of DistanceEngine.
+#
+# Bounds and partial distances only decide what is skipped, with a small
+# tolerance for rounding, and the distances of the results are the exact
+# ones, so the ranking is the one of a full scan, ties broken by index.
+# Pages are aligned with the distance blocks and always computed whole,
+# so np.dot gives every row the value it gets in the full scan.
+
+import numpy as np
+import DistanceEngine
+from Metrics import metrics
+
+# images per page
+PAGE_ROWS = 64
+
+# pages per batch
+BATCH_PAGES = 64
+
+# relative tolerance of the bounds, well above the rounding of the sums
+TOLERANCE = 1e-9
+
+# the partial distance uses the features with the biggest weights that
+# add up to this part of the total weight
+PARTIAL_WEIGHT = 0.5
+
+# when more than this part of the corpus is still left to compute once the
+# k-th best distance is known, a full scan is cheaper than pruning
+FULL_SCAN = 0.5
+
+
+# Per page (min, max) of every feature of the matrix.
+def page_bounds(matrix, page_rows=PAGE_ROWS):
+    pages = -(-len(matrix) // page_rows)
+    mins = np.empty((pages, matrix.shape[1]), dtype=matrix.dtype)
+    maxs = np.empty((pages, matrix.shape[1]), dtype=matrix.dtype)
+    starts = np.arange(0, len(matrix), page_rows)
+    if len(matrix):
+        np.minimum.reduceat(matrix, starts, axis=0, out=mins)
+        np.maximum.reduceat(matrix, starts, axis=0, out=maxs)
+    return mins, maxs
+
+
+# Lower bound of the weighted distance from the query to every page.
+def lower_bounds(query, weights, mins, maxs):
+    below = np.asarray(mins, dtype=np.float64) - query
+    above = query - np.asarray(maxs, dtype=np.float64)
+    gap = np.maximum(np.maximum(below, above), 0)
+    return gap @ weights
+
+
+# The features with the biggest weights, that add up to PARTIAL_WEIGHT of
+# the total weight.
+def heaviest_features(weights):
+    order = np.argsort(-weights, kind="stable")
+    total = weights.sum()
+    if total <= 0:
+        return order
+    count = int(np.searchsorted(np.cumsum(weights[order]), PARTIAL_WEIGHT * total)) + 1
+    return np.sort(order[:count])
+
+
+class PrunedSearch:
+    # Constructor. distanceEngine gives the matrices and the index states.
+    def __init__(self, distanceEngine, page_rows=PAGE_ROWS):
+        if DistanceEngine.BLOCK_ROWS % page_rows:
+            raise ValueError("page_rows must divide the distance block size %d" % DistanceEngine.BLOCK_ROWS)
+        self.distanceEngine = distanceEngine
+        self.page_rows = page_rows
+
+    # Page bounds of the method for the state, made the first time they
+    # are asked for and kept with the state.
+    def get_bounds(self, method, state):
+        key = ("page_bounds", method, self.page_rows)
+        bounds = state.summaries.get(key)
+        if bounds is None:
+            with metrics.timer("pruned.bounds"):
+                bounds = page_bounds(state.get_matrix(method), self.page_rows)
+            state.summaries[key] = bounds
+        return bounds
+
+    # (indices, distances) of the k closest images to the query image,
+    # closest first, like DistanceEngine.query.
+    def query(self, query_index, method, weights, k=None, state=None):
+        state = state or self.distanceEngine.current()
+        return self.query_vector(state.get_matrix(method)[query_index], method, weights, k, state)
+
+    def query_vector(self, query, method, weights, k=None, state=None):
+        state = state or self.distanceEngine.current()
+        matrix = state.get_matrix(method)
+        if k is None or k >= len(matrix):
+            # nothing to prune
+            return self.distanceEngine.query_vector(query, method, weights, k, state=state)
+        query = np.asarray(query, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)[:matrix.shape[1]]
+        if k <= 0:
+            return np.zeros(0, dtype=np.intp), np.zeros(0)
+
+        with metrics.timer("rank.pruned"):
+            mins, maxs = self.get_bounds(method, state)
+            bounds = lower_bounds(query, weights, mins, maxs)
+            order = np.argsort(bounds, kind="stable")
+            sorted_bounds = bounds[order]
+            use_partial = True
+            partial = heaviest_features(weights)
+            best_indices = np.zeros(0, dtype=np.intp)
+            best_distances = np.zeros(0)
+            kth = np.inf
+            computed = 0
+            full_scan = False
+            for start in range(0, len(order), BATCH_PAGES):
+                limit = kth + kth * TOLERANCE
+                # the bounds are sorted, no page from there on can make it
+                stop = int(np.searchsorted(sorted_bounds, limit, side="right"))
+                if stop <= start:
+                    break
+                if start > 0 and (stop - start) * self.page_rows > FULL_SCAN * len(matrix):
+                    full_scan = True
+                    break
+                pages = np.sort(order[start:min(start + BATCH_PAGES, stop)])
+                rows = self.page_rows_of(pages, len(matrix))
+                if len(best_indices) == k and use_partial:
+                    # pages with no image under the k-th best distance on
+                    # the heaviest features alone are dropped
+                    block = matrix[rows][:, partial]
+                    partial_distances = np.abs(block - query[partial]) @ weights[partial]
+                    keep = self.pages_with(partial_distances <= limit, len(pages))
+                    use_partial = keep.mean() < 0.75
+                    pages = pages[keep]
+                    if not len(pages):
+                        continue
+                    rows = self.page_rows_of(pages, len(matrix))
+                distances = DistanceEngine.weighted_distances(matrix[rows], query, weights)
+                computed += len(rows)
+                indices = np.concatenate((best_indices, rows))
+                distances = np.concatenate((best_distances, distances))
+                best = np.lexsort((indices, distances))[:k]
+                best_indices, best_distances = indices[best], distances[best]
+                if len(best_indices) == k:
+                    kth = best_distances[-1]
+        if full_scan:
+            metrics.count("pruned_full_scans")
+            return self.distanceEngine.query_vector(query, method, weights, k, state=state)
+        metrics.count("distances_computed", computed)
+        metrics.count("distances_pruned", len(matrix) - computed)
+        return best_indices, best_distances
+
+    # Rows of the pages, in page order.
+    def page_rows_of(self, pages, count):
+        starts = pages * self.page_rows
+        rows = (starts[:, None] + np.arange(self.page_rows)).ravel()
+        return rows[rows < count]
+
+    # Which of the pages have at least one row where rows_kept is True.
+    def pages_with(self, rows_kept, pages):
+        padded = np.zeros(pages * self.page_rows, dtype=bool)
+        padded[:len(rows_kept)] = rows_kept
+        return padded.reshape(pages, self.page_rows).any(axis=1)
@@ -0,0 +1,96 @@
+# ResultCache.py
+# LRU cache of ranked query results.
+#
+# A result is keyed by the query image, the method, the query options and
+# a hash of the weight vector, so a repeated query (or a query after the
+# weights were reset) is answered from memory. Every entry also remembers
+# the corpus version it was computed for; when the corpus or its
+# normalization statistics change, the whole cache is dropped. A query
+# that still holds an older index state neither reads nor fills the
+# cache, so it can't drop the entries of the newer version.
+
+import hashlib, threading
+from collections import OrderedDict
+import numpy as np
+from Metrics import metrics
+
+
+# Hash of a weight vector, equal weights give equal hashes.
+def weights_hash(weights):
+    return hashlib.sha1(np.asarray(weights, dtype=np.float64).tobytes()).hexdigest()
+
+
+class ResultCache:
+    # Constructor. max_entries bounds the number of cached queries and
+    # max_results the total number of result rows they hold.
+    def __init__(self, max_entries=1024, max_results=1000000):
+        self.max_entries = max_entries
+        self.max_results = max_results
+        self.entries = OrderedDict()
+        self.size = 0
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def make_key(self, image_id, method, weights, options=()):
+        return (image_id, method, weights_hash(weights)) + tuple(options)
+
+    # The first k results cached for the key, or None. A query for fewer
+    # results than were cached is answered from the longer list;
+    # k=None wants the whole ranking.
+    def get(self, key, k, version):
+        with self.lock:
+            if self.is_old(version):
+                self.misses += 1
+                metrics.count("cache_misses")
+                return None
+            if version != self.version:
+                self.clear_locked(version)
+            entry = self.entries.get(key)
+            if entry is not None:
+                cached_k, results = entry
+                if cached_k is None or (k is not None and k <= cached_k):
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    metrics.count("cache_hits")
+                    return results[:] if k is None else results[:k]
+            self.misses += 1
+            metrics.count("cache_misses")
+            return None
+
+    def put(self, key, k, version, results):
+        # fewer results than asked for is the whole ranking
+        if k is not None and len(results) < k:
+            k = None
+        with self.lock:
+            if self.is_old(version):
+                return
+            if version != self.version:
+                self.clear_locked(version)
+            if len(results) > self.max_results:
+                return
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self.entries[key] = (k, results)
+            self.size += len(results)
+            while len(self.entries) > self.max_entries or self.size > self.max_results:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+
+    # Whether version is older than the one the cache holds.
+    def is_old(self, version):
+        return self.version is not None and version < self.version
+
+    def clear(self):
+        with self.lock:
+            self.clear_locked(self.version)
+
+    def clear_locked(self, version):
+        self.entries.clear()
+        self.size = 0
+        self.version = version
+
+    def __len__(self):
+        return len(self.entries)
@@ -0,0 +1,134 @@
+# ResultsView.py
+# Scrollable grid of result thumbnails for the result window.
+#
+# The grid keeps a fixed pool of tiles (a button with the thumbnail and a
+# label with the file name, each in its own canvas window). Only the rows
+# in view are bound to results: when the canvas is scrolled or resized,
+# the tiles are moved to the rows that came into view and get their image
+# and caption swapped. No widget is created or destroyed after the pool
+# is built, however many results a page has.
+
+from tkinter import *
+from collections import OrderedDict
+import math
+
+
+# First and last (exclusive) row of the grid in view, for a view from
+# pixel top to pixel bottom and rows row_height pixels high.
+def visible_rows(top, bottom, row_height, rows):
+    first = max(int(top // row_height), 0)
+    last = min(int(math.ceil(bottom / row_height)), rows)
+    return first, max(first, last)
+
+
+class ResultsView:
+    # Constructor.
+    # get_photo(i) makes the thumbnail photo of image i, on_click(filename)
+    # is called when a tile is clicked. cols is the number of tiles per row
+    # and view_rows the number of rows the canvas shows at a time.
+    def __init__(self, master, get_photo, on_click, tile_width, tile_height,
+                 cols=5, view_rows=2, photo_cache_size=200):
+        self.get_photo = get_photo
+        self.on_click = on_click
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.cols = cols
+        self.results = []
+        # index -> photo, the most recently shown last
+        self.photos = OrderedDict()
+        self.photo_cache_size = photo_cache_size
+        # tile -> result position it shows, or None
+        self.bound = []
+        self.tiles = []
+
+        self.scrollbar = Scrollbar(master)
+        self.scrollbar.pack(side=RIGHT, fill=Y)
+        self.canvas = Canvas(master,
+                             width=tile_width * cols,
+                             height=int(tile_height * view_rows),
+                             yscrollcommand=self.scrollbar.set)
+        self.canvas.pack(fill='both')
+        self.scrollbar.config(command=self.scroll)
+        self.canvas.bind('<Configure>', lambda event: self.refresh())
+
+    # Tiles enough to cover the rows in view, plus a row that is half in
+    # view on each side while scrolling.
+    def pool_size(self):
+        return (int(math.ceil(self.view_height() / self.tile_height)) + 1) * self.cols
+
+    # Height of the canvas on screen, or the asked for height before it
+    # is mapped.
+    def view_height(self):
+        return max(self.canvas.winfo_height(), int(self.canvas.cget('height')))
+
+    def grow_pool(self, size):
+        while len(self.tiles) < size:
+            link = Button(self.canvas)
+            label = Label(link)
+            label.pack(side=BOTTOM)
+            window = self.canvas.create_window(0, 0, anchor=NW, window=link,
+                                               width=self.tile_width,
+                                               height=self.tile_height,
+                                               state='hidden')
+            self.tiles.append((link, label, window))
+            self.bound.append(None)
+
+    # Shows a new list of results, (image index, file name, distance)
+    # tuples, scrolled to the top.
+    def show(self, results):
+        self.results = list(results)
+        rows = int(math.ceil(len(self.results) / self.cols))
+        self.canvas.config(scrollregion=(0, 0, self.tile_width * self.cols, self.tile_height * rows))
+        self.canvas.yview_moveto(0)
+        # the same positions may now hold other images
+        for t, tile in enumerate(self.tiles):
+            self.canvas.itemconfigure(tile[2], state='hidden')
+            self.bound[t] = None
+        self.refresh()
+
+    def scroll(self, *args):
+        self.canvas.yview(*args)
+        self.refresh()
+
+    # Binds the tiles to the results in view, and hides the rest.
+    def refresh(self):
+        self.grow_pool(self.pool_size())
+        rows = int(math.ceil(len(self.results) / self.cols))
+        top = self.canvas.canvasy(0)
+        first, last = visible_rows(top, top + self.view_height(), self.tile_height, rows)
+        positions = range(first * self.cols, min(last * self.cols, len(self.results)))
+
+        # a result keeps its tile while it stays in view
+        wanted = set(positions)
+        free = [t for t, position in enumerate(self.bound) if position not in wanted]
+        showing = {position for position in self.bound if position in wanted}
+        for position in positions:
+            if position not in showing:
+                self.bind_tile(free.pop(), position)
+        for t in free:
+            if self.bound[t] is not None:
+                self.canvas.itemconfigure(self.tiles[t][2], state='hidden')
+                self.bound[t] = None
+
+    def bind_tile(self, t, position):
+        link, label, window = self.tiles[t]
+        i, filename = self.results[position][:2]
+        row, col = divmod(position, self.cols)
+        # the button holds on to its photo, Tk only keeps the name
+        link.photo = self.photo(i)
+        link.config(image=link.photo, command=lambda f=filename: self.on_click(f))
+        label.config(text=filename[7:])
+        self.canvas.coords(window, col * self.tile_width, row * self.tile_height)
+        self.canvas.itemconfigure(window, state='normal')
+        self.bound[t] = position
+
+    # The photo of image i, kept for a while so scrolling back and forth
+    # does not make it again.
+    def photo(self, i):
+        photo = self.photos.pop(i, None)
+        if photo is None:
+            photo = self.get_photo(i)
+        self.photos[i] = photo
+        while len(self.photos) > self.photo_cache_size:
+            self.photos.popitem(last=False)
+        return photo
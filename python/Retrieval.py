@@ -0,0 +1,280 @@
+# Retrieval.py
+# Content-based image retrieval without the GUI.
+#
+# RetrievalEngine loads the corpus through PixInfo and ranks it with the
+# DistanceEngine, so batch jobs and servers can run queries without Tk.
+# Images are identified by their 0-based position in the file list.
+#
+# Command line:
+# python ./python/Retrieval.py 0 --method inten_color_method -k 10
+# python ./python/Retrieval.py 0 --relevant 2 9
+# python ./python/Retrieval.py --example photo.jpg
+# python ./python/Retrieval.py 0 --metrics   (stage timings after the query)
+
+import argparse, io, threading
+import numpy as np
+from PIL import Image
+from PixInfo import PixInfo
+from Normalization import combine_bins, normalize
+from DistanceEngine import DistanceEngine, METHODS, QueryCancelled, size_normalize
+from AnnIndex import AnnIndex
+from Feedback import FeedbackSession
+from ResultCache import ResultCache
+from ShardedSearch import ShardedSearch
+from PrunedSearch import PrunedSearch
+from Cascade import CascadeSearch
+from Metrics import metrics
+
+
+class RetrievalEngine:
+    # Constructor. Loads the corpus, unless an already loaded PixInfo
+    # is passed in. cache_size is the number of rankings kept in the
+    # result cache (0 turns it off). With shards > 1 the exact rankings
+    # are computed by a ShardedSearch over that many shards, on processes
+    # worker processes (one per shard by default).
+    def __init__(self, pixInfo=None, cache_size=1024, shards=1, processes=None):
+        self.pixInfo = pixInfo if pixInfo is not None else PixInfo()
+        self.resultCache = ResultCache(cache_size) if cache_size else None
+        self.distanceEngine = DistanceEngine(self.pixInfo)
+        self.shardedSearch = None
+        if shards > 1:
+            self.shardedSearch = ShardedSearch(self.distanceEngine, shards, processes)
+        self.prunedSearch = PrunedSearch(self.distanceEngine)
+        self.cascadeSearch = CascadeSearch(self.distanceEngine)
+        self.annIndex = None
+        self.annVersion = None
+        # held while an ANN index is built, so only one build runs at a time
+        self.annLock = threading.Lock()
+
+    # Number of images of the current index state.
+    def __len__(self):
+        return len(self.distanceEngine.current())
+
+    def get_file_list(self):
+        return self.distanceEngine.current().fileList
+
+    # A relevance feedback session with its own weights. Queries and
+    # feedback given the session don't touch the weights of anybody else.
+    def new_session(self):
+        return FeedbackSession(self.pixInfo)
+
+    def get_weights(self, session=None):
+        if session is not None:
+            return session.weights
+        return self.pixInfo.weights
+
+    def check_image_id(self, image_id, state=None):
+        count = len(state or self.distanceEngine.current())
+        if not 0 <= image_id < count:
+            raise IndexError("image id %d out of range, the corpus has %d images" % (image_id, count))
+
+    # Builds the approximate nearest neighbor index (see AnnIndex.py) over
+    # the "Color code & Intensity" features of the index state. Builds
+    # are serialized and one for a version that already has its index
+    # returns that index; an index built for an older version than the
+    # one kept is returned but not kept.
+    def build_ann_index(self, nlist=None, iterations=10, state=None):
+        state = state or self.distanceEngine.current()
+        with self.annLock:
+            if self.annIndex is not None and self.annVersion == state.version:
+                return self.annIndex
+            annIndex = AnnIndex(state.get_matrix("inten_color_method"), nlist=nlist, iterations=iterations)
+            if self.annVersion is None or state.version > self.annVersion:
+                self.annIndex, self.annVersion = annIndex, state.version
+            return annIndex
+
+    # The ANN index of the index state, or None when it isn't built yet.
+    # Then a build is started on a background thread, unless one is
+    # already running, and the caller answers the query some other way.
+    def get_ann_index(self, state):
+        annIndex = self.annIndex
+        if annIndex is not None and self.annVersion == state.version:
+            return annIndex
+        if self.annLock.locked():
+            return None
+        thread = threading.Thread(target=self.build_ann_index, kwargs={"state": state},
+                                  name="ann-index-build", daemon=True)
+        thread.start()
+        return None
+
+    # Ranks the corpus against the query image with the given method
+    # ("color_code_method", "intensity_method" or "inten_color_method"),
+    # using the relevance feedback weights of the session (or the shared
+    # ones of pixInfo when there is no session).
+    # Returns a list of (image id, file name, distance), closest first.
+    # k limits the result to the k closest images.
+    # approximate=True answers "inten_color_method" queries from the ANN
+    # index, scanning nprobe partitions, and reranks the top k with the
+    # exact distances unless rerank is False. While the index of the state
+    # is being built the query is answered exactly instead.
+    # pruned=True finds the exact top k with PrunedSearch, which skips the
+    # images that can't make it; the results are the same.
+    # cascade=n shortlists the n images closest on coarse histograms and
+    # ranks only those with the full distance (see Cascade.py).
+    # cancelled() is checked while the exact distances are computed, a
+    # query it cancels raises QueryCancelled.
+    # The whole query reads one index state (the current one by default),
+    # image ids and file names are the ones of that state even if a newer
+    # one is published meanwhile.
+    def query(self, image_id, method="inten_color_method", k=None,
+              approximate=False, nprobe=8, rerank=True, session=None, cancelled=None, pruned=False,
+              cascade=None, state=None):
+        state = state or self.distanceEngine.current()
+        self.check_image_id(image_id, state)
+        weights = self.get_weights(session)
+        approximate = approximate and method == "inten_color_method"
+
+        if self.resultCache is not None:
+            options = ("approximate", nprobe, bool(rerank)) if approximate else ()
+            if cascade and not approximate:
+                options = ("cascade", cascade)
+            key = self.resultCache.make_key(image_id, method, weights, options)
+            results = self.resultCache.get(key, k, state.version)
+            if results is None:
+                results = self.rank(image_id, method, k, approximate, nprobe, rerank, weights, cancelled, state,
+                                    pruned, cascade)
+                self.resultCache.put(key, k, state.version, results)
+                results = list(results)
+            return results
+        return self.rank(image_id, method, k, approximate, nprobe, rerank, weights, cancelled, state, pruned,
+                         cascade)
+
+    # Ranking without the cache, see query.
+    def rank(self, image_id, method, k, approximate, nprobe, rerank, weights, cancelled=None, state=None,
+             pruned=False, cascade=None):
+        metrics.count("queries")
+        state = state or self.distanceEngine.current()
+        if approximate:
+            # the index is rebuilt in the background when the corpus changed
+            # since it was built, the exact engine answers until it's done
+            annIndex = self.get_ann_index(state)
+            if annIndex is not None:
+                query = state.get_matrix(method)[image_id]
+                indices, distances = annIndex.search(query, weights, k or len(state), nprobe, rerank)
+            else:
+                metrics.count("ann_fallbacks")
+                indices, distances = self.distanceEngine.query(image_id, method, weights, k, cancelled, state)
+        elif cascade:
+            if cancelled is not None and cancelled():
+                raise QueryCancelled()
+            indices, distances = self.cascadeSearch.query(image_id, method, weights, k, state, cascade)
+        elif pruned:
+            if cancelled is not None and cancelled():
+                raise QueryCancelled()
+            indices, distances = self.prunedSearch.query(image_id, method, weights, k, state)
+        elif self.shardedSearch is not None:
+            if cancelled is not None and cancelled():
+                raise QueryCancelled()
+            indices, distances = self.shardedSearch.query(image_id, method, weights, k, state)
+        else:
+            indices, distances = self.distanceEngine.query(image_id, method, weights, k, cancelled, state)
+        return [(int(i), state.fileList[i], float(d)) for i, d in zip(indices, distances)]
+
+    # Query by example: ranks the corpus against an image that is not in it.
+    # image is a file name, the bytes of an image file or a PIL image.
+    # The image is encoded like the corpus, normalized with the stored
+    # column averages and stds, and is not added to the corpus.
+    def query_image(self, image, method="inten_color_method", k=None, session=None, state=None):
+        if isinstance(image, (bytes, bytearray)):
+            image = io.BytesIO(image)
+        if isinstance(image, Image.Image):
+            # the caller's image is left open
+            width, height = image.size
+            CcBins, InBins = PixInfo.encode(image, width, height)
+        else:
+            with Image.open(image) as im:
+                width, height = im.size
+                CcBins, InBins = PixInfo.encode(im, width, height)
+
+        state = state or self.distanceEngine.current()
+        vector = self.image_vector(CcBins, InBins, width, height, method, state)
+        search = self.shardedSearch if self.shardedSearch is not None else self.distanceEngine
+        indices, distances = search.query_vector(vector, method, self.get_weights(session), k, state=state)
+        return [(int(i), state.fileList[i], float(d)) for i, d in zip(indices, distances)]
+
+    # The row the image would have in the distance engine matrix of the
+    # method (of the index state).
+    def image_vector(self, CcBins, InBins, width, height, method, state=None):
+        # thumbnail size, like PixInfo.get_image_sizes
+        size = (width // 4) * (height // 4)
+        if size == 0:
+            # the bins would be divided by 0
+            raise ValueError("image too small, %dx%d, the smallest is 4x4" % (width, height))
+        if method == "color_code_method":
+            bins = CcBins[1:]
+        elif method == "intensity_method":
+            bins = InBins
+        else:
+            # normalized with the statistics the matrix was made with
+            state = state or self.distanceEngine.current()
+            bins = normalize(combine_bins(InBins, CcBins[1:])[0],
+                             state.column_avgs, state.column_stds).astype(np.float32)
+        return size_normalize(bins, size)
+
+    # Relevance feedback, the query image and the images the user marked as
+    # relevant are used to update the feature weights. The rows are read
+    # from the current index state, never from the corpus a writer may be
+    # changing, so feedback takes no lock.
+    def apply_feedback(self, query_id, relevant_ids, session=None):
+        relevant = [query_id] + [i for i in relevant_ids if i != query_id]
+        state = self.distanceEngine.current()
+        for image_id in relevant:
+            self.check_image_id(image_id, state)
+        with metrics.timer("feedback"):
+            if session is not None:
+                return session.update(relevant, state.features)
+            self.pixInfo.update_weights(relevant, state.features)
+        return self.pixInfo.weights
+
+    # Back to equal weights for every feature.
+    def reset_feedback(self, session=None):
+        if session is not None:
+            session.reset()
+        else:
+            self.pixInfo.reset_weights()
+
+
+# Executable section.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find the images closest to a query image.")
+    parser.add_argument("image", type=int, nargs="?", help="0-based id of the query image")
+    parser.add_argument("--example", help="query with this image file instead of an image of the corpus")
+    parser.add_argument("--method", default="inten_color_method", choices=METHODS)
+    parser.add_argument("-k", type=int, default=20, help="number of results to show")
+    parser.add_argument("--relevant", type=int, nargs="*", default=[],
+                        help="ids of images relevant to the query, applied as feedback before ranking")
+    parser.add_argument("--approximate", action="store_true",
+                        help="use the approximate index (inten_color_method only)")
+    parser.add_argument("--nprobe", type=int, default=8, help="partitions scanned by the approximate index")
+    parser.add_argument("--no-rerank", action="store_true",
+                        help="skip the exact rerank of the approximate results")
+    parser.add_argument("--pruned", action="store_true",
+                        help="exact top k that skips the images that can't make it")
+    parser.add_argument("--cascade", type=int, metavar="N",
+                        help="rank only the N images closest on coarse histograms with the full distance")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="split the exact search over this many shards and worker processes")
+    parser.add_argument("--metrics", action="store_true", help="print the stage timings and counters")
+    args = parser.parse_args()
+    if args.metrics:
+        metrics.enable()
+
+    if (args.image is None) == (args.example is None):
+        parser.error("give either an image id or --example")
+
+    engine = RetrievalEngine(shards=args.shards)
+    if args.approximate:
+        engine.build_ann_index()
+    if args.example is not None:
+        results = engine.query_image(args.example, args.method, args.k)
+    else:
+        if args.relevant:
+            engine.apply_feedback(args.image, args.relevant)
+        results = engine.query(args.image, args.method, args.k, approximate=args.approximate,
+                               nprobe=args.nprobe, rerank=not args.no_rerank, pruned=args.pruned,
+                               cascade=args.cascade)
+    for rank, (image_id, filename, distance) in enumerate(results, 1):
+        print("%3d  %6d  %-30s %.6g" % (rank, image_id, filename, distance))
+    if args.metrics:
+        print()
+        print(metrics.report())
@@ -0,0 +1,295 @@
+# Server.py
+# HTTP/JSON retrieval service, no GUI needed.
+#
+# Run it from the top of the repo:
+# python ./python/Server.py --port 8000 --workers 4
+#
+# Endpoints:
+# GET  /health                         number of images
+# POST /sessions                       new relevance feedback session -> {"session": id}
+# DELETE /sessions/<id>                drop a session
+# GET  /query?image=0&method=inten_color_method&offset=0&limit=20&session=<id>
+#                                      a page of the ranking for a query image
+#                                      (approximate=1 and nprobe=n use the ANN index,
+#                                      pruned=1 the exact pruned search,
+#                                      cascade=n the cascade with a shortlist of n)
+# POST /query-image?method=...&offset=0&limit=20&session=<id>
+#                                      query by example, the body is an image file
+# POST /feedback                       {"session": id, "image": 0, "relevant": [2, 9]}
+# POST /feedback/reset                 {"session": id}
+# GET  /metrics                        stage timings and counters (CBIR_METRICS=1)
+#
+# Image ids are 0-based positions in the file list. Queries and feedback
+# run on a pool of worker threads, the HTTP threads only wait for them.
+# With --watch n the images folder is checked every n seconds and images
+# added, modified or removed are picked up while serving (see Watcher.py).
+
+import argparse, json, signal, threading, traceback, uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+from Retrieval import RetrievalEngine
+from Watcher import DirectoryWatcher
+from PixInfo import get_joint_table
+from DistanceEngine import METHODS
+from Metrics import metrics
+
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 1000
+MAX_UPLOAD_BYTES = 32 * 1024 * 1024
+
+
+# Raised for bad requests, turned into a 4xx JSON error.
+class RequestError(Exception):
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+class RetrievalService:
+    # Constructor.
+    # max_sessions bounds the number of feedback sessions kept, the least
+    # recently used ones are dropped first.
+    def __init__(self, engine, workers=4, max_sessions=10000):
+        self.engine = engine
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.sessions = OrderedDict()
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+
+    def new_session(self):
+        session_id = uuid.uuid4().hex
+        with self.lock:
+            self.sessions[session_id] = self.engine.new_session()
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        return session_id
+
+    def drop_session(self, session_id):
+        with self.lock:
+            if self.sessions.pop(session_id, None) is None:
+                raise RequestError("unknown session %s" % session_id, 404)
+
+    def get_session(self, session_id):
+        if session_id is None:
+            return None
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is None:
+                raise RequestError("unknown session %s" % session_id, 404)
+            self.sessions.move_to_end(session_id)
+        return session
+
+    def check_image(self, image_id, state=None):
+        count = len(state or self.engine.distanceEngine.current())
+        if not 0 <= image_id < count:
+            raise RequestError("image %d out of range, the corpus has %d images" % (image_id, count), 404)
+
+    def check_page(self, method, offset, limit):
+        if method not in METHODS:
+            raise RequestError("unknown method %r, expected one of %s" % (method, ", ".join(METHODS)))
+        if offset < 0 or not 0 < limit <= MAX_PAGE_SIZE:
+            raise RequestError("offset must be >= 0 and limit between 1 and %d" % MAX_PAGE_SIZE)
+
+    # One page of the ranking. Only the images up to the end of the page
+    # are selected, the rest of the corpus is never sorted. The query and
+    # the page read the same index state.
+    def query(self, image_id, method, offset, limit, session_id=None, approximate=False, nprobe=8,
+              pruned=False, cascade=None):
+        self.check_page(method, offset, limit)
+        state = self.engine.distanceEngine.current()
+        self.check_image(image_id, state)
+        session = self.get_session(session_id)
+        results = self.pool.submit(self.engine.query, image_id, method, offset + limit,
+                                   approximate=approximate, nprobe=nprobe, session=session,
+                                   pruned=pruned, cascade=cascade, state=state).result()
+        return self.page(results, offset, limit, state, image=image_id, method=method)
+
+    # One page of the ranking for an uploaded image.
+    def query_image(self, data, method, offset, limit, session_id=None):
+        self.check_page(method, offset, limit)
+        state = self.engine.distanceEngine.current()
+        session = self.get_session(session_id)
+        try:
+            results = self.pool.submit(self.engine.query_image, data, method, offset + limit,
+                                       session=session, state=state).result()
+        except OSError:
+            raise RequestError("body is not an image file")
+        return self.page(results, offset, limit, state, method=method)
+
+    # The page of the results, total is the size of the index state the
+    # results were ranked in.
+    def page(self, results, offset, limit, state, **query):
+        page = results[offset:offset + limit]
+        return dict(query, **{
+            "total": len(state),
+            "offset": offset,
+            "limit": limit,
+            "results": [{"rank": offset + rank + 1, "id": i, "file": filename, "distance": distance}
+                        for rank, (i, filename, distance) in enumerate(page)],
+        })
+
+    def feedback(self, session_id, image_id, relevant):
+        session = self.get_session(session_id)
+        if session is None:
+            raise RequestError("feedback needs a session")
+        self.check_image(image_id)
+        for i in relevant:
+            self.check_image(i)
+        weights = self.pool.submit(self.engine.apply_feedback, image_id, relevant, session).result()
+        return {"session": session_id, "rounds": len(session.history), "weights": [float(w) for w in weights]}
+
+    def reset_feedback(self, session_id):
+        session = self.get_session(session_id)
+        if session is None:
+            raise RequestError("reset needs a session")
+        self.engine.reset_feedback(session)
+        return {"session": session_id}
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    # set by serve()
+    service = None
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length == 0:
+            return {}
+        try:
+            body = json.loads(self.rfile.read(length))
+        except ValueError:
+            raise RequestError("body is not valid JSON")
+        if not isinstance(body, dict):
+            raise RequestError("body must be a JSON object")
+        return body
+
+    def read_bytes(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if length == 0:
+            raise RequestError("the body is empty")
+        if length > MAX_UPLOAD_BYTES:
+            raise RequestError("the body is larger than %d bytes" % MAX_UPLOAD_BYTES, 413)
+        return self.rfile.read(length)
+
+    def handle_request(self, handler):
+        try:
+            self.send_json(handler())
+        except RequestError as e:
+            self.send_json({"error": str(e)}, e.status)
+        except (ValueError, TypeError, KeyError) as e:
+            self.send_json({"error": "bad request: %s" % e}, 400)
+        except Exception as e:
+            # anything else is a bug, the client still gets JSON
+            traceback.print_exc()
+            self.send_json({"error": "internal error: %s" % e}, 500)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path == "/health":
+            self.handle_request(lambda: {"images": len(self.service.engine)})
+        elif url.path == "/metrics":
+            self.handle_request(metrics.snapshot)
+        elif url.path == "/query":
+            self.handle_request(lambda: self.service.query(
+                int(params["image"]),
+                params.get("method", "inten_color_method"),
+                int(params.get("offset", 0)),
+                int(params.get("limit", DEFAULT_PAGE_SIZE)),
+                params.get("session"),
+                params.get("approximate", "0") in ("1", "true"),
+                int(params.get("nprobe", 8)),
+                params.get("pruned", "0") in ("1", "true"),
+                int(params["cascade"]) if "cascade" in params else None))
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        path = url.path
+        params = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if path == "/sessions":
+            self.handle_request(lambda: {"session": self.service.new_session()})
+        elif path == "/query-image":
+            self.handle_request(lambda: self.service.query_image(
+                self.read_bytes(),
+                params.get("method", "inten_color_method"),
+                int(params.get("offset", 0)),
+                int(params.get("limit", DEFAULT_PAGE_SIZE)),
+                params.get("session")))
+        elif path == "/feedback":
+            def feedback():
+                body = self.read_json()
+                return self.service.feedback(body.get("session"), int(body["image"]),
+                                             [int(i) for i in body.get("relevant", [])])
+            self.handle_request(feedback)
+        elif path == "/feedback/reset":
+            self.handle_request(lambda: self.service.reset_feedback(self.read_json().get("session")))
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_DELETE(self):
+        path = urlparse(self.path).path
+        if path.startswith("/sessions/"):
+            session_id = path[len("/sessions/"):]
+            self.handle_request(lambda: self.service.drop_session(session_id) or {"session": session_id})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+
+# Starts the server and serves until interrupted.
+# Serves until Ctrl+C or SIGTERM, then stops the worker threads and the
+# shard worker processes (and frees their shared memory).
+def serve(service, host="127.0.0.1", port=8000):
+    RequestHandler.service = service
+    # the lookup table of the encode is made now, not by the first upload
+    get_joint_table()
+    server = ThreadingHTTPServer((host, port), RequestHandler)
+
+    # shutdown waits for serve_forever to return, so it can't be called
+    # from the handler, which runs on the thread of serve_forever
+    def on_sigterm(signum, frame):
+        threading.Thread(target=server.shutdown, name="server-shutdown").start()
+    previous = None
+    if threading.current_thread() is threading.main_thread():
+        previous = signal.signal(signal.SIGTERM, on_sigterm)
+
+    print("Serving %d images on http://%s:%d" % (len(service.engine), host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if previous is not None:
+            signal.signal(signal.SIGTERM, previous)
+        server.server_close()
+        service.pool.shutdown()
+        if service.engine.shardedSearch is not None:
+            service.engine.shardedSearch.close()
+
+
+# Executable section.
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve image retrieval over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=4, help="query worker threads")
+    parser.add_argument("--shards", type=int, default=1,
+                        help="split the exact search over this many shards and worker processes")
+    parser.add_argument("--watch", type=float, metavar="SECONDS",
+                        help="pick up changes to the images folder every SECONDS seconds")
+    args = parser.parse_args()
+
+    engine = RetrievalEngine(shards=args.shards)
+    if args.watch:
+        DirectoryWatcher(engine, interval=args.watch).start()
+    serve(RetrievalService(engine, workers=args.workers), args.host, args.port)
@@ -0,0 +1,169 @@
+# ShardedSearch.py
+# Exact search split over shards of the corpus, on a pool of processes.
+#
+# The size-normalized matrix of every method is copied once into shared
+# memory, and every worker process maps it, so a query only sends the
+# query vector and the weights. The rows are split into contiguous
+# shards; each shard is scanned with the same blocked distance code as the
+# DistanceEngine and returns its own top k, and the shards' results are
+# merged by (distance, image index). A shard's top k holds every image of
+# the shard that can be in the global top k, with ties already broken by
+# index, so the merged ranking is the one a single scan gives.
+#
+# Shards are made of whole distance blocks (BLOCK_ROWS rows): the result
+# of np.dot for a row can differ in the last bit with the row's position
+# in the block, and this way every row is computed exactly as in the
+# single scan. A corpus of fewer blocks than shards uses fewer shards.
+#
+# The matrices are copied to shared memory again when a newer index state
+# is published. Every version's blocks are counted by the queries that
+# use them, and the blocks of an older version are unlinked when its last
+# query is done. A query on a state older than the newest copied one,
+# whose blocks are gone, runs on the DistanceEngine in this process.
+
+import atexit, multiprocessing, threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+import DistanceEngine
+from DistanceEngine import METHODS, MATRIX_DTYPE, weighted_distances, top_k
+from Metrics import metrics
+
+# method -> (shared memory name, SharedMemory, array), in every worker
+# process
+attached = {}
+
+
+# The matrix of the method in the shared memory block, attached once per
+# worker process. The block of an older corpus version is let go.
+def attach(method, name, shape):
+    entry = attached.get(method)
+    if entry is None or entry[0] != name:
+        if entry is not None:
+            shm = attached.pop(method)[1]
+            entry = None
+            shm.close()
+        shm = shared_memory.SharedMemory(name=name)
+        entry = (name, shm, np.ndarray(shape, dtype=MATRIX_DTYPE, buffer=shm.buf))
+        attached[method] = entry
+    return entry[2]
+
+
+# Worker process: the k closest rows of rows start to stop of the shared
+# matrix, as global (indices, distances), closest first.
+def search_shard(method, name, shape, start, stop, query, weights, k):
+    shard = attach(method, name, shape)[start:stop]
+    distances = weighted_distances(shard, query, weights)
+    indices = top_k(distances, k)
+    return indices + start, distances[indices]
+
+
+# Ranking of the merged shard results, ties broken by image index.
+def merge(results, k):
+    indices = np.concatenate([indices for indices, _ in results])
+    distances = np.concatenate([distances for _, distances in results])
+    order = np.lexsort((indices, distances))[:k]
+    return indices[order], distances[order]
+
+
+class ShardedSearch:
+    # Constructor. The matrices of distanceEngine are split into shards
+    # shards, searched by processes worker processes (one per shard by
+    # default).
+    def __init__(self, distanceEngine, shards=4, processes=None):
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+        self.distanceEngine = distanceEngine
+        self.shards = shards
+        # the workers are started by a fork server, not forked from this
+        # process, which has threads (the server's, the watcher's) whose
+        # locks a fork could copy while held
+        self.pool = ProcessPoolExecutor(max_workers=processes or shards,
+                                        mp_context=multiprocessing.get_context("forkserver"))
+        # version -> [{method -> (SharedMemory, shape)}, queries using it]
+        self.versions = {}
+        # newest version copied to shared memory
+        self.version = None
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    # Copies the matrices of the index state to shared memory, as the
+    # newest version. The lock is held.
+    def refresh(self, state):
+        blocks = {}
+        for method in METHODS:
+            matrix = state.get_matrix(method)
+            shm = shared_memory.SharedMemory(create=True, size=max(matrix.nbytes, 1))
+            np.ndarray(matrix.shape, dtype=MATRIX_DTYPE, buffer=shm.buf)[:] = matrix
+            blocks[method] = (shm, matrix.shape)
+        previous = self.version
+        self.versions[state.version] = [blocks, 0]
+        self.version = state.version
+        if previous is not None and self.versions[previous][1] == 0:
+            self.release(self.versions.pop(previous)[0])
+
+    # The shared memory blocks of the index state, counted as used until
+    # done(state) is called. None if the state is older than the blocks.
+    def acquire(self, state):
+        with self.lock:
+            entry = self.versions.get(state.version)
+            if entry is None:
+                if self.version is not None and state.version < self.version:
+                    return None
+                self.refresh(state)
+                entry = self.versions[state.version]
+            entry[1] += 1
+            return entry[0]
+
+    def done(self, state):
+        with self.lock:
+            entry = self.versions[state.version]
+            entry[1] -= 1
+            if entry[1] == 0 and state.version != self.version:
+                self.release(self.versions.pop(state.version)[0])
+
+    # Row ranges of the shards, whole blocks each and as even as possible.
+    def shard_bounds(self, rows):
+        block_rows = DistanceEngine.BLOCK_ROWS
+        blocks = max(-(-rows // block_rows), 1)
+        edges = np.linspace(0, blocks, min(self.shards, blocks) + 1).astype(int) * block_rows
+        edges = np.minimum(edges, rows)
+        return list(zip(edges[:-1], edges[1:]))
+
+    # (indices, distances) of the k closest images to the query image,
+    # closest first, like DistanceEngine.query.
+    def query(self, query_index, method, weights, k=None, state=None):
+        state = state or self.distanceEngine.current()
+        return self.query_vector(state.get_matrix(method)[query_index], method, weights, k, state)
+
+    def query_vector(self, query, method, weights, k=None, state=None):
+        state = state or self.distanceEngine.current()
+        blocks = self.acquire(state)
+        if blocks is None:
+            return self.distanceEngine.query_vector(query, method, weights, k, state=state)
+        try:
+            shm, shape = blocks[method]
+            query = np.asarray(query, dtype=np.float64)
+            weights = np.asarray(weights, dtype=np.float64)
+            with metrics.timer("rank.sharded"):
+                futures = [self.pool.submit(search_shard, method, shm.name, shape, start, stop, query, weights, k)
+                           for start, stop in self.shard_bounds(shape[0])]
+                results = merge([future.result() for future in futures], k)
+        finally:
+            self.done(state)
+        metrics.count("distances_computed", shape[0])
+        return results
+
+    def release(self, blocks):
+        for shm, _ in blocks.values():
+            shm.close()
+            shm.unlink()
+
+    # Stops the worker processes and frees the shared memory.
+    def close(self):
+        self.pool.shutdown()
+        with self.lock:
+            for blocks, _ in self.versions.values():
+                self.release(blocks)
+            self.versions = {}
+            self.version = None
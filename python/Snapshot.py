@@ -0,0 +1,62 @@
+# Snapshot.py
+# Warm start: the fully loaded state of PixInfo saved to disk.
+#
+# When PixInfo has to build its state from the text files (parsing them,
+# reading the size of every image and normalizing the features), it saves
+# the result as a snapshot: a feature store (see FeatureStore.py) with the
+# bins, image sizes, column averages and stds, the normalized feature
+# matrix and the file list. The snapshot file is named after a
+# fingerprint of the corpus, so the next start with the same corpus opens
+# it (memory mapped, in milliseconds) and any change falls back to a
+# rebuild.
+#
+# The fingerprint covers the sorted file list of the images folder, the
+# size and mtime of every image, and the size and mtime of intensity.txt,
+# colorCodes.txt and features.bin, everything the loaded state is made
+# from. An image edited or replaced in place gives a new fingerprint, so
+# the snapshot made before the edit is not loaded.
+
+import glob, hashlib, os
+from FeatureStore import FeatureStore, VERSION
+
+FEATURE_FILES = ("intensity.txt", "colorCodes.txt", "features.bin")
+
+
+# Fingerprint of the corpus, as a hex string.
+def corpus_fingerprint(fileList, feature_files=FEATURE_FILES):
+    digest = hashlib.sha1()
+    digest.update(b"store version %d\n" % VERSION)
+    for name in list(fileList) + list(feature_files):
+        try:
+            st = os.stat(name)
+            digest.update(("%s %d %d\n" % (name, st.st_size, st.st_mtime_ns)).encode("utf-8"))
+        except OSError:
+            digest.update(("%s missing\n" % name).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class Snapshot:
+    # Constructor.
+    def __init__(self, snapshot_dir=".snapshot"):
+        self.snapshot_dir = snapshot_dir
+
+    def get_path(self, fingerprint):
+        return os.path.join(self.snapshot_dir, fingerprint + ".bin")
+
+    # Path of the snapshot for the fingerprint, or None if there is none.
+    def find(self, fingerprint):
+        path = self.get_path(fingerprint)
+        return path if os.path.exists(path) else None
+
+    # Saves a snapshot for the fingerprint and deletes the older ones,
+    # which no longer match the corpus.
+    def save(self, fingerprint, fileList, intenCode, colorCode, dims,
+             column_avgs, column_stds, feature_matrix):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        path = self.get_path(fingerprint)
+        FeatureStore.write(path, fileList, intenCode, colorCode, dims,
+                           column_avgs, column_stds, feature_matrix)
+        for old in glob.glob(os.path.join(self.snapshot_dir, "*.bin")):
+            if old != path:
+                os.remove(old)
+        return path
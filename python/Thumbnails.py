@@ -0,0 +1,64 @@
+# Thumbnails.py
+# On-disk cache of the thumbnails shown in the GUI.
+#
+# A thumbnail is the image resized to a quarter of its width and height.
+# They are saved in the cache folder under the content hash of the image,
+# so a renamed or copied image reuses its thumbnail and an edited image
+# gets a new one.
+
+import os
+from PIL import Image
+from Indexer import file_hash
+from Metrics import metrics
+
+
+# The thumbnail of an image, a quarter of its width and height.
+def make_thumbnail(im):
+    x = int(im.size[0] / 4)
+    y = int(im.size[1] / 4)
+    return im.resize((x, y), Image.LANCZOS)
+
+
+class ThumbnailCache:
+    # Constructor.
+    def __init__(self, cache_dir=".thumbnails"):
+        self.cache_dir = cache_dir
+        # path -> (size, mtime, hash), so a file is only hashed again
+        # when it changed
+        self.hashes = {}
+
+    def get_hash(self, path):
+        st = os.stat(path)
+        known = self.hashes.get(path)
+        if known is not None and known[0] == st.st_size and known[1] == st.st_mtime_ns:
+            return known[2]
+        sha1 = file_hash(path)
+        self.hashes[path] = (st.st_size, st.st_mtime_ns, sha1)
+        return sha1
+
+    def get_path(self, path):
+        return os.path.join(self.cache_dir, self.get_hash(path) + ".png")
+
+    # The thumbnail of the image file, read from the cache, or made and
+    # saved to it the first time.
+    def get(self, path):
+        cached = self.get_path(path)
+        try:
+            with Image.open(cached) as thumb:
+                thumb.load()
+                metrics.count("thumbnail_hits")
+                return thumb
+        except (IOError, OSError):
+            pass
+
+        metrics.count("thumbnail_misses")
+        with metrics.timer("thumbnail"):
+            with Image.open(path) as im:
+                thumb = make_thumbnail(im.convert("RGB"))
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # save under a temporary name first, so another process never
+        # reads half a thumbnail
+        tmp = "%s.%d.tmp" % (cached, os.getpid())
+        thumb.save(tmp, format="PNG")
+        os.replace(tmp, cached)
+        return thumb
@@ -0,0 +1,166 @@
+# Watcher.py
+# Keeps a running engine up to date with the images folder.
+#
+# A daemon thread looks at the images folder every interval seconds and
+# compares the size and mtime of every *.jpg with what it saw last time.
+# New and modified images are encoded first, without holding anything.
+# Then, with pixInfo locked, removed and modified images are taken out,
+# new and modified ones added (the column statistics follow, see
+# PixInfo.add_image), and the DistanceEngine publishes a new index state.
+#
+# Queries never wait for it: a query takes the published state once and
+# reads only that (see DistanceEngine.IndexState), and while the watcher
+# holds pixInfo the engine keeps handing out the previous state. The
+# features.bin store is rewritten after every change, in the order of the
+# images folder, so the next start opens it instead of the text files,
+# and the changed images are inserted into the near-duplicate index
+# (duplicates.npz, when the Indexer made one).
+#
+# Image ids are positions in the file list, so they can change when an
+# image is removed; results always carry the file name too.
+
+import glob, os, threading
+from FeatureStore import FeatureStore
+from Duplicates import load_index, signature
+from PixInfo import PixInfo, numericalSort, get_joint_table
+from Metrics import metrics
+
+
+# path -> (size, mtime) of every *.jpg of the folder.
+def scan(image_dir):
+    files = {}
+    for path in glob.glob(os.path.join(image_dir, '*.jpg')):
+        try:
+            st = os.stat(path)
+        except OSError:
+            # removed while scanning
+            continue
+        files[path] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+class DirectoryWatcher:
+    # Constructor. engine is a RetrievalEngine, its corpus is expected to
+    # be the images of image_dir. draft_scale is the JPEG draft scale to
+    # encode with (see PixInfo.encode_file), store_file the feature store
+    # to rewrite after a change (None to leave it alone), duplicates_file
+    # the near-duplicate index to update (None to leave it alone).
+    def __init__(self, engine, image_dir="images", interval=2.0, draft_scale=1, store_file="features.bin",
+                 duplicates_file="duplicates.npz"):
+        self.engine = engine
+        self.pixInfo = engine.pixInfo
+        self.image_dir = image_dir
+        self.interval = interval
+        self.draft_scale = draft_scale
+        self.store_file = store_file
+        self.duplicates_file = duplicates_file
+        self.duplicates = load_index(duplicates_file) if duplicates_file is not None else None
+        # the images of the corpus as they were when it was loaded
+        self.known = {}
+        for path in self.pixInfo.get_file_list():
+            try:
+                st = os.stat(path)
+                self.known[path] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                self.known[path] = None
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            # the lookup table of the encode is made now, not by the first
+            # change
+            get_joint_table()
+            self.thread = threading.Thread(target=self.run, name="directory-watcher", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.poll()
+            except Exception as e:
+                print("watcher: %s" % e)
+
+    # Looks at the folder once and applies the changes. Returns
+    # (added, modified, removed) file names.
+    def poll(self):
+        files = scan(self.image_dir)
+        added = sorted((path for path in files if path not in self.known), key=numericalSort)
+        modified = sorted((path for path in files if path in self.known and files[path] != self.known[path]),
+                          key=numericalSort)
+        removed = sorted((path for path in self.known if path not in files), key=numericalSort)
+        if not (added or modified or removed):
+            # a batch of changes that got old enough is normalized now
+            with self.pixInfo.lock:
+                if self.pixInfo.refresh_if_due():
+                    self.engine.distanceEngine.refresh()
+            return added, modified, removed
+
+        with metrics.timer("watch.encode"):
+            encoded = {}
+            for path in added + modified:
+                try:
+                    encoded[path] = PixInfo.encode_file(path, self.draft_scale)
+                except (IOError, OSError, ValueError) as e:
+                    # still being written, it is seen again next time
+                    print("watcher: could not encode %s: %s" % (path, e))
+                    files.pop(path)
+        added = [path for path in added if path in encoded]
+        modified = [path for path in modified if path in encoded]
+
+        with metrics.timer("watch.update"), self.pixInfo.lock:
+            for path in removed + modified:
+                fileList = self.pixInfo.get_file_list()
+                if path in fileList:
+                    self.pixInfo.remove_image(list(fileList).index(path))
+            for path in modified + added:
+                dims, CcBins, InBins = encoded[path]
+                self.pixInfo.add_image(path, CcBins, InBins, dims)
+            # publishes the new index state
+            self.engine.distanceEngine.refresh()
+            if self.store_file is not None:
+                store_rows = self.store_rows()
+        # the store is renormalized and written without holding pixInfo
+        if self.store_file is not None:
+            self.write_store(*store_rows)
+        if self.duplicates is not None:
+            self.update_duplicates(removed, modified + added, encoded)
+        metrics.count("watch.changes", len(added) + len(modified) + len(removed))
+
+        for path in removed:
+            del self.known[path]
+        for path in added + modified:
+            self.known[path] = files[path]
+        return added, modified, removed
+
+    # Copies of the file list, bins and dims of pixInfo, in the order of the
+    # folder, the order PixInfo loads them in.
+    def store_rows(self):
+        fileList = self.pixInfo.get_file_list()
+        order = sorted(range(len(fileList)), key=lambda i: numericalSort(fileList[i]))
+        return ([fileList[i] for i in order], self.pixInfo.get_intenCode()[order],
+                self.pixInfo.get_colorCode()[order], self.pixInfo.dims[order])
+
+    # Takes the removed images out of the near-duplicate index, puts the
+    # changed ones in and saves it.
+    def update_duplicates(self, removed, changed, encoded):
+        for path in removed:
+            self.duplicates.remove(path)
+        self.duplicates.add(changed, [signature(encoded[path][1], encoded[path][2]) for path in changed])
+        try:
+            self.duplicates.save(self.duplicates_file)
+        except (IOError, OSError, ValueError) as e:
+            print("watcher: could not write %s: %s" % (self.duplicates_file, e))
+
+    # Rewrites the feature store with the rows of store_rows.
+    def write_store(self, fileList, intenCode, colorCode, dims):
+        try:
+            FeatureStore.write(self.store_file, fileList, intenCode, colorCode, dims)
+        except (IOError, OSError, ValueError) as e:
+            print("watcher: could not write %s: %s" % (self.store_file, e))
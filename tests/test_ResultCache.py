@@ -0,0 +1,35 @@
+# test_ResultCache.py
+# Run it from the top of the repo:
+# python -m pytest tests
+
+import os, sys
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "python"))
+from ResultCache import ResultCache
+
+
+def results(n, tag):
+    return [(i, "images/%d.jpg" % i, float(tag)) for i in range(n)]
+
+
+# A query on an older index state, between queries on the newer one,
+# neither drops the newer entries nor puts its own in.
+def test_old_version_does_not_clear():
+    cache = ResultCache()
+    cache.put(("a",), 5, 2, results(5, 2))
+    for _ in range(3):
+        assert cache.get(("b",), 5, 1) is None
+        cache.put(("b",), 5, 1, results(5, 1))
+        assert cache.get(("a",), 5, 2) == results(5, 2)
+    assert cache.version == 2
+    assert len(cache) == 1
+    assert cache.get(("b",), 5, 2) is None
+
+
+# A newer version drops the entries of the older one.
+def test_new_version_clears():
+    cache = ResultCache()
+    cache.put(("a",), 5, 1, results(5, 1))
+    assert cache.get(("a",), 5, 2) is None
+    assert cache.version == 2
+    assert len(cache) == 0
+    assert cache.get(("a",), 5, 1) is None